@@ -1,15 +1,18 @@
-from collections import deque
-from lstore.page import Page, PhysicalPage
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from lstore.page import Page, PhysicalPage, COLUMN_STRUCT, get_updated_schema
 from lstore.record import Record
 from pathlib import Path
 import os
 from lstore.config import (
     NUM_RECORDS_START,
-    NUM_RECORDS_END,
     BUFFERPOOL_SIZE,
+    NUM_FLUSH_WORKERS,
+    PHYS_PAGE_PATH_CACHE_SIZE,
+    NUM_PAGE_LOCK_STRIPES,
     PAGE_SIZE,
     MAX_BASE_PAGES,
-    PHYSICAL_PAGE_METADATA_SIZE,
+    DATA_START,
     COLUMN_SIZE,
     INDIRECTION_COLUMN,
     RID_COLUMN,
@@ -17,26 +20,43 @@ from lstore.config import (
     SCHEMA_ENCODING_COLUMN,
     DATA_COL_START,
     TPS_START,
-    TPS_END,
     NUM_UPDATES_START,
-    NUM_UPDATES_END,
 )
 import threading
-import mmap
+import functools
+import queue
+import traceback
+import weakref
 
 
 class Bufferpool:
     def __init__(self, db):
-        self.pages = {}
+        # The least recently used pages are at the front of the dictionary
+        # and the most recently used ones are at the end
+        self.pages = OrderedDict()
         self.max_capacity = BUFFERPOOL_SIZE
         self.db = db
 
-        # The least recently used pages are at the front of the queue
-        # and the most recently used ones are at the end
-        self.lru_pages = deque()
-
         self.evict_lock = threading.Lock()
-        self.page_locks = {}
+
+        # Maps {(<table name>, <page range #>, <page #>) : <RID column PhysicalPage>}
+        # Caches the physical page holding a page's TPS and number of updates
+        self.header_pages = weakref.WeakValueDictionary()
+
+        # Physical pages share a fixed number of locks, picked by hashing their path
+        self.stripe_locks = [threading.Lock() for i in range(NUM_PAGE_LOCK_STRIPES)]
+
+        # Evicted dirty pages are queued as (<path>, <data>) and written by a
+        # background thread, so evictions do not wait on disk writes
+        self.dirty_queue = queue.Queue(maxsize=BUFFERPOOL_SIZE)
+        # Maps {<path> : <data>} for queued writes that have not reached disk yet
+        # Pages read back before their write finishes are filled from here
+        self.pending_writes = {}
+        self.pending_writes_lock = threading.Lock()
+        self.write_back_thread = threading.Thread(
+            target=self.__write_back_dirty_pages, daemon=True
+        )
+        self.write_back_thread.start()
 
     def has_capacity(self):
         if len(self.pages) == self.max_capacity:
@@ -91,95 +111,191 @@ class Bufferpool:
             table_name, page_range_num, page_num, column_num
         )
 
-        # If the bufferpool is currently using a page, wait until the page is available
-        if self.page_locks.get(phys_page_path, -1) == -1:
-            self.page_locks[phys_page_path] = threading.Lock()
-            self.page_locks[phys_page_path].acquire()
-        else:
-            self.page_locks[phys_page_path].acquire()
-
-        # Return the page if it is in the bufferpool
-        if self.pages.get(phys_page_path, -1) != -1:
-            self.page_locks[phys_page_path].release()
-            return self.pages[phys_page_path]
+        # Return the page if it is in the bufferpool without taking a lock
+        # Dictionary lookups are atomic, and a page evicted after this lookup
+        # stays valid for this reader until it drops its reference to the page
+        page = self.pages.get(phys_page_path, -1)
+        if page != -1:
+            return self.__get_filled_page(
+                phys_page_path, page, table_name, page_range_num, page_num, column_num
+            )
 
-        # Get the page from disk and add it to the bufferpool if there is space
-        # Otherwise evict the least recently used page and then get the page
-        if not self.has_capacity() and add_to_bufferpool:
-            self.__evict()
+        # Pages that are not added to the bufferpool are not shared,
+        # so they can be read from disk without any locking
+        if not add_to_bufferpool:
+            page = PhysicalPage()
+            self.__fill_phys_page(phys_page_path, page)
+            return page
+
+        # Only misses take a stripe lock, and only long enough to reserve
+        # a spot in the bufferpool for the page
+        lock = self.stripe_locks[hash(phys_page_path) % NUM_PAGE_LOCK_STRIPES]
+        with lock:
+            # Check again since another thread may have added the page while waiting
+            # It is waited on after the lock is released, since a failed read
+            # takes the lock to remove its page
+            page = self.pages.get(phys_page_path, -1)
+            is_added = page == -1
+            if is_added:
+                # Evict the least recently used page if the bufferpool is full
+                if not self.has_capacity():
+                    self.__evict()
+
+                # Add an empty physical page to the end of the bufferpool
+                # Its fill lock is held until its data has been read from disk
+                page = PhysicalPage()
+                page.is_filled = False
+                page.fill_lock.acquire()
+                self.pages[phys_page_path] = page
+
+        if not is_added:
+            return self.__get_filled_page(
+                phys_page_path, page, table_name, page_range_num, page_num, column_num
+            )
 
-        page = self.__fetch_phys_page(phys_page_path)
+        # Read the page from disk outside of the stripe lock so that misses on
+        # other pages of the same stripe do not wait for this read
+        try:
+            self.__fill_phys_page(phys_page_path, page)
+        except BaseException:
+            # Remove the unread page so that it is never used as the page's data
+            with lock:
+                if self.pages.get(phys_page_path, None) is page:
+                    del self.pages[phys_page_path]
+            page.is_evicted = True
+            page.fill_lock.release()
+            raise
+
+        page.is_filled = True
+        page.fill_lock.release()
+        return page
 
-        if add_to_bufferpool:
-            # Add the physical page to the bufferpool
-            self.pages[phys_page_path] = page
+    # Returns @page, found in the bufferpool, once its data has been read from disk
+    # If the read failed, the page is looked up again, reading it from disk
+    def __get_filled_page(
+        self, phys_page_path, page, table_name, page_range_num, page_num, column_num
+    ):
+        if not page.is_filled:
+            with page.fill_lock:
+                pass
 
-            # Add the key of the physical page to the end of the queue
-            self.lru_pages.append(phys_page_path)
+            if not page.is_filled:
+                return self.__get_physical_page_helper(
+                    table_name, page_range_num, page_num, column_num, True
+                )
 
-        self.page_locks[phys_page_path].release()
+        self.__mark_recently_used(phys_page_path)
         return page
 
+    # Moves a page to the end of the bufferpool since it is the most recently used
+    def __mark_recently_used(self, phys_page_path):
+        try:
+            self.pages.move_to_end(phys_page_path)
+        except KeyError:
+            # The page was evicted after it was found, so there is nothing to move
+            pass
+
+    # Returns the RID column's physical page of a page, which holds the page's
+    # TPS and number of updates, without looking it up in the bufferpool if cached
+    def __get_header_page(self, table_name, page_range_num, page_num):
+        key = (table_name, page_range_num, page_num)
+        phys_page = self.header_pages.get(key, None)
+        if phys_page == None or phys_page.is_evicted:
+            phys_page = self.get_physical_page(
+                table_name, page_range_num, page_num, RID_COLUMN
+            )
+            self.header_pages[key] = phys_page
+
+        return phys_page
+
     def get_tps(self, table_name, page_range_num, page_num):
-        phys_page = self.get_physical_page(
-            table_name, page_range_num, page_num, RID_COLUMN
-        )
+        phys_page = self.__get_header_page(table_name, page_range_num, page_num)
 
-        return int.from_bytes(phys_page.data[TPS_START:TPS_END], "big", signed=True)
+        return COLUMN_STRUCT.unpack_from(phys_page.data, TPS_START)[0]
 
     def get_num_updates(self, table_name, page_range_num, page_num):
-        phys_page = self.get_physical_page(
-            table_name, page_range_num, page_num, RID_COLUMN
-        )
+        phys_page = self.__get_header_page(table_name, page_range_num, page_num)
 
-        return int.from_bytes(
-            phys_page.data[NUM_UPDATES_START:NUM_UPDATES_END], "big", signed=True
-        )
+        return COLUMN_STRUCT.unpack_from(phys_page.data, NUM_UPDATES_START)[0]
 
     def set_tps(self, table_name, page_range_num, page_num, new_tps):
-        phys_page = self.get_physical_page(
-            table_name, page_range_num, page_num, RID_COLUMN
-        )
+        phys_page = self.__get_header_page(table_name, page_range_num, page_num)
 
-        phys_page.data[TPS_START:TPS_END] = new_tps.to_bytes(COLUMN_SIZE, "big")
+        COLUMN_STRUCT.pack_into(phys_page.data, TPS_START, new_tps)
+        phys_page.is_dirty = True
 
     def set_num_updates(self, table_name, page_range_num, page_num, num_updates):
-        phys_page = self.get_physical_page(
-            table_name, page_range_num, page_num, RID_COLUMN
-        )
+        phys_page = self.__get_header_page(table_name, page_range_num, page_num)
+
+        COLUMN_STRUCT.pack_into(phys_page.data, NUM_UPDATES_START, num_updates)
+        phys_page.is_dirty = True
 
-        phys_page.data[NUM_UPDATES_START:NUM_UPDATES_END] = num_updates.to_bytes(
-            COLUMN_SIZE, "big"
+    # Applies an update to its base record in one pass: increments the base page's
+    # number of updates, points the base record's indirection to @tail_rid and sets
+    # the schema encoding bits of the columns whose value changed
+    # Returns the base page's new number of updates
+    def base_record_post_update(
+        self, table_name, base_location, tail_rid, old_columns, new_columns
+    ):
+        page_range_num, page_num, offset = base_location
+        header_page = self.__get_header_page(table_name, page_range_num, page_num)
+        indirection_page = self.get_physical_page(
+            table_name, page_range_num, page_num, INDIRECTION_COLUMN
+        )
+        schema_page = self.get_physical_page(
+            table_name, page_range_num, page_num, SCHEMA_ENCODING_COLUMN
         )
+        phys_pages = (header_page, indirection_page, schema_page)
+        self.pin_physical_pages(phys_pages)
+
+        # Other updates to the same base page race on the number of updates
+        with header_page.lock:
+            data = header_page.data
+            num_updates = COLUMN_STRUCT.unpack_from(data, NUM_UPDATES_START)[0] + 1
+            COLUMN_STRUCT.pack_into(data, NUM_UPDATES_START, num_updates)
+            header_page.is_dirty = True
+
+        # Update base record's indirection to point to new tail record
+        indirection_page.change_val(tail_rid, offset)
+        indirection_page.is_dirty = True
+
+        # Change the corresponding bit to a 1 if a column is updated
+        # The first column is the most significant bit
+        updated_bits = get_updated_schema(old_columns, new_columns)
+
+        # Bitwise or with the old schema to include the previous columns that were
+        # updated, and only write it if a new column was updated
+        old_schema = schema_page.read_val(offset)
+        if old_schema | updated_bits != old_schema:
+            schema_page.change_val(old_schema | updated_bits, offset)
+            schema_page.is_dirty = True
+
+        self.unpin_physical_pages(phys_pages)
+
+        return num_updates
 
     # Return a record object
     def get_record(self, table_name, rid):
-        # Find all metadata values first
-        metadata_columns = [
-            INDIRECTION_COLUMN,
-            RID_COLUMN,
-            TIMESTAMP_COLUMN,
-            SCHEMA_ENCODING_COLUMN,
-        ]
-        metadata = []
-        for col in metadata_columns:
-            metadata.append(self.get_record_column_val(table_name, rid, col))
-
-        # Find all corresponding data values
+        # Find the record using the page directory once
+        table = self.db.get_table(table_name)
+        page_range_num, page_num, offset = table.use_page_directory("r", rid, None)
+
+        return self.get_record_at(table_name, page_range_num, page_num, offset)
+
+    # Return a record object given the location of the record
+    def get_record_at(self, table_name, page_range_num, page_num, offset):
+        # Read the metadata and data values of every column from the same page
         # num_columns is the same for base and tail pages
-        num_columns = self.db.get_table(table_name).total_num_columns
-        columns = []
-        for i in range(DATA_COL_START, num_columns):
-            value = self.get_record_column_val(table_name, rid, i)
-            columns.append(value)
+        page = self.get_page(table_name, page_range_num, page_num)
+        values = page.read_row(offset)
 
         # Create record object
+        key = self.db.get_table(table_name).key
         record = Record(
-            metadata[RID_COLUMN], self.db.get_table(table_name).key, columns
+            values[RID_COLUMN], key, values[DATA_COL_START:], values[TIMESTAMP_COLUMN]
         )
-        record.indirection = metadata[INDIRECTION_COLUMN]
-        record.timestamp = metadata[TIMESTAMP_COLUMN]
-        record.schema_encoding = metadata[SCHEMA_ENCODING_COLUMN]
+        record.indirection = values[INDIRECTION_COLUMN]
+        record.schema_encoding = values[SCHEMA_ENCODING_COLUMN]
 
         return record
 
@@ -191,21 +307,13 @@ class Bufferpool:
         # Get the physical page containing the corresponding column value
         page = self.get_physical_page(table_name, page_range_num, page_num, column_num)
 
-        data_start_index = offset * COLUMN_SIZE + PHYSICAL_PAGE_METADATA_SIZE
-        data_end_index = (
-            (offset * COLUMN_SIZE) + COLUMN_SIZE + PHYSICAL_PAGE_METADATA_SIZE
-        )
-
-        data = int.from_bytes(
-            page.data[data_start_index:data_end_index],
-            "big",
-            signed=True,
-        )
-        return data
+        data_start_index = DATA_START + COLUMN_SIZE * offset
+        return COLUMN_STRUCT.unpack_from(page.data, data_start_index)[0]
 
     # Create a page range folder and return the page range's number
     def create_page_range(self, table_name):
-        max_pr_num = self.get_highest_page_range_num(table_name)
+        table = self.db.get_table(table_name)
+        max_pr_num = table.num_page_ranges - 1
 
         # If the page range still has capacity, do not add a new one
         if max_pr_num != -1 and self.page_range_has_capacity(table_name, max_pr_num):
@@ -215,29 +323,31 @@ class Bufferpool:
         # add a new page range
         max_pr_num += 1
 
-        # Go to the given table's folder, make it if it doesn't exist
+        # Make the given table's folder if it doesn't exist
         table_path = self.db.path + "/" + table_name
-        self.__go_to_path(table_path)
+        os.makedirs(table_path, exist_ok=True)
 
         # Names of page range folders are "page_range<#>", where <#> starts at 0
-        page_range_name = "page_range" + str(max_pr_num)
-        os.mkdir(page_range_name)
+        page_range_path = table_path + "/page_range" + str(max_pr_num)
+        os.mkdir(page_range_path)
 
-        self.db.get_table(table_name).num_page_ranges += 1
-        self.db.get_table(table_name).page_ranges_metadata.append(
-            [max_pr_num, -1, MAX_BASE_PAGES - 1]
-        )
+        # Metadata goes in first so readers of num_page_ranges always find it
+        table.page_ranges_metadata.append([max_pr_num, -1, MAX_BASE_PAGES - 1])
+        table.num_page_ranges += 1
 
         return max_pr_num
 
     # Creates a base page and initializes it with physical pages
     def insert_base_page(self, table_name, page_range_num):
-        # Go to the given page range's folder and get the highest base page's number
+        # Make the given page range's folder if it doesn't exist
+        # and get the highest base page's number
         page_range_path = (
             self.db.path + "/" + table_name + "/page_range" + str(page_range_num)
         )
-        self.__go_to_path(page_range_path)
-        max_bp_num = self.get_highest_base_page_num(table_name, page_range_num)
+        os.makedirs(page_range_path, exist_ok=True)
+        table = self.db.get_table(table_name)
+        pr_metadata = table.page_ranges_metadata[page_range_num]
+        max_bp_num = pr_metadata[1]
 
         if max_bp_num != -1 and self.page_has_capacity(
             table_name, page_range_num, max_bp_num
@@ -250,31 +360,29 @@ class Bufferpool:
             return False
 
         # Otherwise, create the base page
-        page_name = "page" + str(max_bp_num + 1)
-        os.mkdir(page_name)
-        os.chdir(page_name)
-
-        num_columns = self.db.get_table(table_name).total_num_columns
+        page_path = page_range_path + "/page" + str(max_bp_num + 1)
+        os.mkdir(page_path)
 
         # Create physical pages
-        for i in range(num_columns):
-            phys_page_name = "col" + str(i)
-            with open(phys_page_name, "wb") as f:
-                f.write(bytearray(PAGE_SIZE))
+        for i in range(table.total_num_columns):
+            self.__create_phys_page_file(page_path + "/col" + str(i))
 
         # Update page range metadata's base page number
-        self.db.get_table(table_name).page_ranges_metadata[page_range_num][1] += 1
+        pr_metadata[1] += 1
 
         return True
 
     # Creates a tail page and initializes it with physical pages
     def insert_tail_page(self, table_name, page_range_num):
-        # Go to the given page range's folder and get the highest base page's number
+        # Make the given page range's folder if it doesn't exist
+        # and get the highest tail page's number
         page_range_path = (
             self.db.path + "/" + table_name + "/page_range" + str(page_range_num)
         )
-        self.__go_to_path(page_range_path)
-        tail_page_num = self.get_highest_tail_page_num(table_name, page_range_num)
+        os.makedirs(page_range_path, exist_ok=True)
+        table = self.db.get_table(table_name)
+        pr_metadata = table.page_ranges_metadata[page_range_num]
+        tail_page_num = pr_metadata[2]
 
         if tail_page_num != MAX_BASE_PAGES - 1 and self.page_has_capacity(
             table_name, page_range_num, tail_page_num
@@ -286,32 +394,41 @@ class Bufferpool:
         tail_page_num += 1
 
         # Create the tail page
-        page_name = "page" + str(tail_page_num)
-        os.mkdir(page_name)
-        os.chdir(page_name)
+        page_path = page_range_path + "/page" + str(tail_page_num)
+        os.mkdir(page_path)
 
         # Create physical pages
-        num_columns = self.db.get_table(table_name).total_num_columns
-        for i in range(num_columns):
-            phys_page_name = "col" + str(i)
-            with open(phys_page_name, "wb") as f:
-                f.write(bytearray(PAGE_SIZE))
+        for i in range(table.total_num_columns):
+            self.__create_phys_page_file(page_path + "/col" + str(i))
 
         # Update page range metadata's tail page number (starts at MAX_BASE_PAGES)
-        self.db.get_table(table_name).page_ranges_metadata[page_range_num][2] += 1
+        pr_metadata[2] += 1
 
         return True
 
     def page_range_has_capacity(self, table_name, page_range_num):
         # Check if there are less than 16 base pages
         # If so, the page range still has capacity
-        max_bp_num = self.get_highest_base_page_num(table_name, page_range_num)
+        pr_metadata = self.db.get_table(table_name).page_ranges_metadata
+        max_bp_num = pr_metadata[page_range_num][1]
         if max_bp_num < MAX_BASE_PAGES - 1:
             return True
 
         # Otherwise, check the capacity of base page #16's physical pages
         return self.page_has_capacity(table_name, page_range_num, max_bp_num)
 
+    # Returns the greatest TID in a tail page, or -1 if the page is empty
+    # TIDs increase within a page, so only the RID of the last record is read
+    def peek_max_tid(self, table_name, page_range_num, page_num):
+        phys_page = self.get_physical_page(
+            table_name, page_range_num, page_num, RID_COLUMN
+        )
+        num_records = phys_page.num_records
+        if num_records == 0:
+            return -1
+
+        return phys_page.read_val(num_records - 1)
+
     def page_has_capacity(self, table_name, page_range_num, page_num):
         # Get a physical page of the corresponding page
         phys_page = self.get_physical_page(table_name, page_range_num, page_num, 0)
@@ -320,20 +437,53 @@ class Bufferpool:
 
     # Takes in a Page object and pins all of its physical pages
     def pin_page(self, page):
-        for p in page.columns:
-            p.use_pin_count("i")
+        self.pin_physical_pages(page.columns)
 
     # Takes in a Page object and unpins all of its physical pages
     def unpin_page(self, page):
-        for p in page.columns:
+        self.unpin_physical_pages(page.columns)
+
+    # Pins each physical page in @phys_pages
+    # The pin count is changed under the page's lock, so concurrent pins and
+    # unpins of the same page are never lost
+    def pin_physical_pages(self, phys_pages):
+        for p in phys_pages:
+            p.use_pin_count("i")
+
+    # Unpins each physical page in @phys_pages
+    def unpin_physical_pages(self, phys_pages):
+        for p in phys_pages:
             p.use_pin_count("d")
 
     def flush(self):
-        keys = self.pages.keys()
-        for k in keys:
-            self.__write_page_to_disk(k)
+        # Let queued writes finish first so they cannot overwrite newer data
+        # If the write-back thread has stopped, the queued writes are done here
+        if self.write_back_thread.is_alive():
+            self.dirty_queue.join()
+        else:
+            self.__drain_dirty_queue()
+
+        # Retry the queued writes that failed, before the pages that may be newer
+        with self.pending_writes_lock:
+            failed_writes = list(self.pending_writes.items())
+        for phys_page_path, data in failed_writes:
+            self.__write_data_to_disk(phys_page_path, data)
+            self.__remove_pending_write(phys_page_path, data)
+
+        # Only dirty pages differ from their copy on disk
+        dirty_paths = [k for k, pg in list(self.pages.items()) if pg.is_dirty]
+
+        # Submit the writes of all dirty pages at once and wait for them to finish
+        with ThreadPoolExecutor(NUM_FLUSH_WORKERS) as pool:
+            list(pool.map(self.__write_page_to_disk, dirty_paths))
         self.pages.clear()
-        self.lru_pages.clear()
+        self.header_pages.clear()
+
+    # Flushes the bufferpool and stops the write-back thread
+    def close(self):
+        self.flush()
+        self.dirty_queue.put(None)
+        self.write_back_thread.join()
 
     def write_page_to_disk(self, table_name, page_range_num, page_num, page):
         for i in range(DATA_COL_START, len(page.columns)):
@@ -349,6 +499,7 @@ class Bufferpool:
 
             with open(col_file_name, "wb") as f:
                 physical_page = page.columns[i]
+                physical_page.flush_metadata()
                 f.write(physical_page.data)
 
     # Frees up a spot in the bufferpool
@@ -362,7 +513,8 @@ class Bufferpool:
 
         page_to_evict = None
         key_of_page = None
-        for path in self.lru_pages:
+        # Iterate over a snapshot of the keys since page hits reorder self.pages
+        for path in list(self.pages):
             phys_pg = self.pages[path]
 
             # Evict the first page that has a pin count of 0
@@ -373,68 +525,133 @@ class Bufferpool:
 
         # If all pages are pinned, return False
         if page_to_evict == None:
+            self.evict_lock.release()
             return False
 
-        # Write the page to disk
+        # Snapshot a dirty page's data before it leaves the bufferpool so
+        # a concurrent miss on the same path is filled from the snapshot
+        data = None
         if page_to_evict.is_dirty:
-            self.__write_page_to_disk(key_of_page)
+            page_to_evict.flush_metadata()
+            data = bytes(page_to_evict.data)
+            with self.pending_writes_lock:
+                self.pending_writes[key_of_page] = data
 
         # Remove the physical page from the bufferpool
-        self.pages.pop(key_of_page)
-        self.lru_pages.remove(key_of_page)
-        self.page_locks.pop(key_of_page)
+        # and invalidate any cached reference to it
+        del self.pages[key_of_page]
+        page_to_evict.is_evicted = True
         self.evict_lock.release()
 
-    # Retrieve a page from disk
-    def __fetch_phys_page(self, phys_page_path):
-        data = None
-
-        with open(phys_page_path, "r+b") as f:
-            mmap_obj = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-            data = bytearray(mmap_obj.read())
+        # Write the page's data outside of the lock
+        # Once the write-back thread has stopped, write it directly
+        if data != None:
+            if self.write_back_thread.is_alive():
+                self.dirty_queue.put((key_of_page, data))
+            else:
+                self.__write_data_to_disk(key_of_page, data)
+                self.__remove_pending_write(key_of_page, data)
+        return True
 
-        retrieved_pg = PhysicalPage()
-        retrieved_pg.data = data
-        retrieved_pg.num_records = int.from_bytes(
-            data[NUM_RECORDS_START:NUM_RECORDS_END], "big", signed=True
-        )
-        retrieved_pg.tps = int.from_bytes(data[TPS_START:TPS_END], "big", signed=True)
-        retrieved_pg.num_updates = int.from_bytes(
-            data[NUM_UPDATES_START:NUM_UPDATES_END], "big", signed=True
-        )
+    # Retrieve a page's data from disk into @page
+    def __fill_phys_page(self, phys_page_path, page):
+        # Read the file directly into the page's buffer to avoid extra copies
+        # Any bytes missing from the file are left as zeros
+        # The buffer is not an mmap of the file since an evicted page must stay
+        # readable by threads still holding it, and merges replace column files
+        data = page.data
+        pending_data = self.pending_writes.get(phys_page_path, None)
+        if pending_data != None:
+            data[:] = pending_data
+        else:
+            with open(phys_page_path, "rb") as f:
+                f.readinto(data)
 
-        return retrieved_pg
+        page.num_records = COLUMN_STRUCT.unpack_from(data, NUM_RECORDS_START)[0]
+        page.tps = COLUMN_STRUCT.unpack_from(data, TPS_START)[0]
+        page.num_updates = COLUMN_STRUCT.unpack_from(data, NUM_UPDATES_START)[0]
 
     # Persists the physical page to disk
     def __write_page_to_disk(self, phys_page_path):
-        with open(phys_page_path, "r+b") as f:
-            mmap_obj = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
-            physical_page = self.pages[phys_page_path]
-            mmap_obj.write(physical_page.data)
-
-    def __go_to_path(self, destination):
-        home_path = self.db.path
-        directories_to_go_to = [destination]
-
-        # Get the path of all directories from home to destination
-        for i in range(len(Path(destination).parents)):
-            parent_dir_path = str(Path(destination).parents[i])
-            if home_path == parent_dir_path:
-                break
-            directories_to_go_to.append(parent_dir_path)
+        physical_page = self.pages[phys_page_path]
+        physical_page.flush_metadata()
+        self.__write_data_to_disk(phys_page_path, physical_page.data)
+
+    def __write_data_to_disk(self, phys_page_path, data):
+        fd = os.open(phys_page_path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, 0)
+        finally:
+            os.close(fd)
+
+    # Runs on the write-back thread, writing queued pages until None is queued
+    def __write_back_dirty_pages(self):
+        while True:
+            item = self.dirty_queue.get()
+            if item == None:
+                self.dirty_queue.task_done()
+                return
+
+            try:
+                self.__write_back(*item)
+            finally:
+                self.dirty_queue.task_done()
 
-        # Go to each directory in directories_to_go_to and make them if they do not exist
-        # Iterate backwards since the order in directories_to_go_to is in reverse
-        for i in range(len(directories_to_go_to) - 1, -1, -1):
+    # Writes the queued pages on the calling thread until the queue is empty
+    def __drain_dirty_queue(self):
+        while True:
             try:
-                os.chdir(str(directories_to_go_to[i]))
-            except FileNotFoundError:
-                os.mkdir(str(directories_to_go_to[i]))
-                os.chdir(str(directories_to_go_to[i]))
+                item = self.dirty_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                if item != None:
+                    self.__write_back(*item)
+            finally:
+                self.dirty_queue.task_done()
+
+    # Writes a queued page to disk
+    # A failed write is reported and its data is kept in pending_writes, so the
+    # page is still read from it and flush writes it again
+    def __write_back(self, phys_page_path, data):
+        try:
+            self.__write_data_to_disk(phys_page_path, data)
+        except Exception:
+            traceback.print_exc()
+            return
+        self.__remove_pending_write(phys_page_path, data)
+
+    # Forgets @data once it is on disk
+    # Only if the page was not evicted again since
+    def __remove_pending_write(self, phys_page_path, data):
+        with self.pending_writes_lock:
+            if self.pending_writes.get(phys_page_path, None) is data:
+                del self.pending_writes[phys_page_path]
+
+    # Creates an empty physical page file of PAGE_SIZE bytes
+    # The file is sparse, so it reads as zeros without writing any data
+    def __create_phys_page_file(self, phys_page_path):
+        fd = os.open(phys_page_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, PAGE_SIZE)
+        finally:
+            os.close(fd)
 
     # Returns the path of a physical page
     def __create_phys_page_path(self, table_name, page_range_num, page_num, column_num):
-        phys_page_path = self.db.path + "/" + table_name
+        return Bufferpool.__build_phys_page_path(
+            self.db.path, table_name, page_range_num, page_num, column_num
+        )
+
+    # Builds the path of a physical page
+    # Cached since the same paths are built on every bufferpool access
+    @staticmethod
+    @functools.lru_cache(maxsize=PHYS_PAGE_PATH_CACHE_SIZE)
+    def __build_phys_page_path(
+        db_path, table_name, page_range_num, page_num, column_num
+    ):
+        phys_page_path = db_path + "/" + table_name
         phys_page_path += "/page_range" + str(page_range_num)
         phys_page_path += "/page" + str(page_num)
         phys_page_path += "/col" + str(column_num)
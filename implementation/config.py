@@ -15,8 +15,21 @@ TPS_START = 8
 TPS_END = 16
 NUM_UPDATES_START = 16
 NUM_UPDATES_END = 24
+# Values start right after the metadata of a physical page
+DATA_START = PHYSICAL_PAGE_METADATA_SIZE
+MAX_RECORDS_PER_PAGE = (PAGE_SIZE - PHYSICAL_PAGE_METADATA_SIZE) // COLUMN_SIZE
 BUFFERPOOL_SIZE = 128
+NUM_PAGE_LOCK_STRIPES = 64
+NUM_FLUSH_WORKERS = 8
+NUM_SELECT_WORKERS = 8
+PARALLEL_SELECT_THRESHOLD = 64
+PHYS_PAGE_PATH_CACHE_SIZE = 4096
+NUM_INDEX_SHARDS = 16
+SORTED_KEYS_BLOCK_SIZE = 512
+NUM_LOCK_MANAGER_SHARDS = 64
+NUM_PAGE_DIRECTORY_SHARDS = 64
 MERGE_CONDITION = 1024
+MERGE_PAGE_POOL_SIZE = 4
 CREATE_INDICES_CONDITION = 5000
 
 # Constants for query parameters
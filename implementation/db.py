@@ -1,5 +1,9 @@
 from lstore.table import Table
 from lstore.bufferpool import Bufferpool
+from lstore.config import NUM_FLUSH_WORKERS
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from array import array
 import os
 import pickle
 
@@ -7,6 +11,8 @@ import pickle
 class Database:
     def __init__(self):
         self.tables = []
+        # Maps {<table name> : <Table>} for constant time lookups
+        self.tables_by_name = {}
         self.bufferpool = Bufferpool(self)
         self.path = ""
 
@@ -35,7 +41,7 @@ class Database:
             # Create table object with data read from catalog
             line = catalog_data[i]
             table = Table(line[0], int(line[1]), int(line[2]), self.bufferpool)
-            table.num_records = int(line[3])
+            table.set_num_records(int(line[3]))
 
             # Initialize page_ranges_metadata and num_page_ranges
             with open(self.path + "/" + table.name + "/page_ranges_metadata", "r") as f:
@@ -48,6 +54,7 @@ class Database:
             table.num_page_ranges = len(table.page_ranges_metadata)
 
             self.tables.append(table)
+            self.tables_by_name[table.name] = table
 
         # Initialize indices, page directories, number of page ranges, and number of records
         for t in self.tables:
@@ -55,16 +62,21 @@ class Database:
 
             # Initialize indices
             index_file_path = table_path + "/index"
-            t.index.indices = pickle.load(open(index_file_path, "rb"))
+            t.index.set_indices(pickle.load(open(index_file_path, "rb")))
 
             # Initialize page directories
             page_directory_file_path = self.path + "/" + t.name + "/page_directory"
-            t.page_directory = pickle.load(open(page_directory_file_path, "rb"))
+            t.set_page_directory(self.__load_page_directory(page_directory_file_path))
 
     def close(self):
-        self.bufferpool.flush()
+        # Let outstanding merges finish before their pages are flushed
+        for t in self.tables:
+            t.merge_queue.join()
+        self.bufferpool.close()
 
         catalog_lines = []
+        # (save function, path, object) tuples that are saved concurrently after the loop
+        objects_to_save = []
         # Save catalog, indices, page directories, and page range metadata
         for t in self.tables:
             # Get all lines to write to the catalog
@@ -75,19 +87,27 @@ class Database:
                 + " "
                 + str(t.key)
                 + " "
-                + str(t.num_records)
+                + str(t.use_num_records("r"))
             )
             catalog_lines.append(line)
 
             # Save indices using pickle
             # Path: "<db_name>/<table_name>/index"
             index_file_path = self.path + "/" + t.name + "/index"
-            pickle.dump(t.index.indices, open(index_file_path, "wb"))
+            objects_to_save.append(
+                (self.__save_object, index_file_path, t.index.indices)
+            )
 
-            # Save page directories using pickle
+            # Save page directories as arrays of integers
             # Path: "<db_name>/<table_name>/page_directory"
             page_directory_file_path = self.path + "/" + t.name + "/page_directory"
-            pickle.dump(t.page_directory, open(page_directory_file_path, "wb"))
+            objects_to_save.append(
+                (
+                    self.__save_page_directory,
+                    page_directory_file_path,
+                    t.page_directory_shards,
+                )
+            )
 
             # Update page range metadata
             # Format: "<page_range_num> <num_base_pages> <num_tail_pages>"
@@ -97,6 +117,12 @@ class Database:
                     line_to_string = " ".join([str(i) for i in line])
                     f.write(line_to_string + "\n")
 
+        # Save the indices and page directories of all tables concurrently
+        with ThreadPoolExecutor(NUM_FLUSH_WORKERS) as pool:
+            futures = [pool.submit(save, p, obj) for save, p, obj in objects_to_save]
+            for f in futures:
+                f.result()
+
         # Save catalog
         # Format: "<table_name> <num_columns> <key> <num_records>"
         # Path: "<db_name>/catalog"
@@ -105,6 +131,37 @@ class Database:
             for l in catalog_lines:
                 f.write(l + "\n")
 
+    # Pickles the object to the path
+    def __save_object(self, path, obj):
+        with open(path, "wb") as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Saves a page directory as one contiguous array of 64-bit integers
+    # Format: all RIDs, followed by the (page_range_num, page_num, offset) of each RID
+    # Every shard is written in turn, so the RIDs and locations stay in the same order
+    def __save_page_directory(self, path, page_directory_shards):
+        rids = array("q", chain.from_iterable(page_directory_shards))
+        locations = array(
+            "q",
+            chain.from_iterable(
+                chain.from_iterable(shard.values() for shard in page_directory_shards)
+            ),
+        )
+        with open(path, "wb") as f:
+            rids.tofile(f)
+            locations.tofile(f)
+
+    # Loads a page directory saved by __save_page_directory
+    def __load_page_directory(self, path):
+        entries = array("q")
+        with open(path, "rb") as f:
+            entries.frombytes(f.read())
+
+        num_rids = len(entries) // 4
+        rids = entries[:num_rids]
+        locations = entries[num_rids:]
+        return dict(zip(rids, zip(locations[0::3], locations[1::3], locations[2::3])))
+
     """
     # Creates a new table
     :param name: string         #Table name
@@ -114,20 +171,19 @@ class Database:
 
     def create_table(self, name, num_columns, key_index):
         # If a table with the same name has already been created, return None
-        for t in self.tables:
-            if t.name == name:
-                return None
+        if name in self.tables_by_name:
+            return None
 
         table = Table(name, num_columns, key_index, self.bufferpool)
 
         # Create the table folder
         try:
-            os.chdir(self.path)
             os.mkdir(self.path + "/" + name)
         except (FileNotFoundError, FileExistsError):
             pass
 
         self.tables.append(table)
+        self.tables_by_name[name] = table
         return table
 
     """
@@ -135,18 +191,16 @@ class Database:
     """
 
     def drop_table(self, name):
-        for table in self.tables:
-            if table.name == name:
-                self.tables.remove(table)
-                return True
-        return False
+        table = self.tables_by_name.pop(name, None)
+        if table == None:
+            return False
+
+        self.tables.remove(table)
+        return True
 
     """
     # Returns table with the passed name
     """
 
     def get_table(self, name):
-        for table in self.tables:
-            if table.name == name:
-                return table
-        return None
\ No newline at end of file
+        return self.tables_by_name.get(name, None)
\ No newline at end of file
@@ -1,77 +1,202 @@
 from lstore.config import (
+    INDIRECTION_COLUMN,
+    INDIRECTION_NULL,
     RID_COLUMN,
     DATA_COL_START,
     COLUMN_SIZE,
+    NUM_INDEX_SHARDS,
+    SORTED_KEYS_BLOCK_SIZE,
 )
+from collections import defaultdict
+from itertools import chain
+import bisect
 import threading
 
 
+# The keys of one column's index in sorted order, used by locate_range
+# Kept as a list of sorted blocks, so adding or removing a key only moves the
+# keys of one block instead of all of them
+class SortedKeys:
+    def __init__(self, keys):
+        self.lock = threading.Lock()
+        keys = sorted(keys)
+        self.blocks = [
+            keys[i : i + SORTED_KEYS_BLOCK_SIZE]
+            for i in range(0, len(keys), SORTED_KEYS_BLOCK_SIZE)
+        ]
+        # Largest key of each block, to find the block a key belongs in
+        self.maxes = [block[-1] for block in self.blocks]
+
+    def add(self, key):
+        with self.lock:
+            if len(self.blocks) == 0:
+                self.blocks.append([key])
+                self.maxes.append(key)
+                return
+
+            # Keys larger than every other key go in the last block
+            i = min(bisect.bisect_left(self.maxes, key), len(self.blocks) - 1)
+            block = self.blocks[i]
+            bisect.insort(block, key)
+            self.maxes[i] = block[-1]
+
+            # Split blocks that grew too large in half
+            if len(block) > 2 * SORTED_KEYS_BLOCK_SIZE:
+                half = len(block) // 2
+                self.blocks[i : i + 1] = [block[:half], block[half:]]
+                self.maxes[i : i + 1] = [block[half - 1], block[-1]]
+
+    def remove(self, key):
+        with self.lock:
+            i = bisect.bisect_left(self.maxes, key)
+            if i == len(self.blocks):
+                return
+            block = self.blocks[i]
+            j = bisect.bisect_left(block, key)
+            if j == len(block) or block[j] != key:
+                return
+
+            del block[j]
+            if len(block) == 0:
+                del self.blocks[i]
+                del self.maxes[i]
+            else:
+                self.maxes[i] = block[-1]
+
+    # Returns a list of all keys from @begin to @end, inclusive
+    def get_range(self, begin, end):
+        keys = []
+        with self.lock:
+            i = bisect.bisect_left(self.maxes, begin)
+            while i < len(self.blocks):
+                block = self.blocks[i]
+                lo = bisect.bisect_left(block, begin)
+                hi = bisect.bisect_right(block, end)
+                keys += block[lo:hi]
+                # The rest of the blocks only have keys past @end
+                if hi < len(block):
+                    break
+                i += 1
+        return keys
+
+
 class Index:
     def __init__(self, table):
         # One index for each table. All are empty initially.
+        # An index is split into NUM_INDEX_SHARDS hash maps, picked by hashing the value
+        # RIDs are stored in sets so they can be removed without scanning
         self.indices = [None] * table.total_num_columns
         self.table = table
+        # Column number of the primary key, including the metadata columns
+        self.key_column = table.key + DATA_COL_START
+
+        # Each shard of each column has its own lock, so lookups and updates
+        # only wait on others that touch the same shard
+        self.shard_locks = [
+            [threading.Lock() for i in range(NUM_INDEX_SHARDS)]
+            for j in range(table.total_num_columns)
+        ]
+        # Serializes creating and dropping indices
         self.lock = threading.Lock()
 
-    # Returns True if a column is indexed and False otherwise
-    def is_indexed(self, column):
-        self.lock.acquire()
+        # SortedKeys of each indexed column, kept up to date as keys are
+        # added and removed under their shard's lock
+        self.sorted_keys = [None] * table.total_num_columns
 
-        res = self.indices[column] != None
+        # The primary key is indexed from the start, so no insert can run
+        # before its index exists
+        self.sorted_keys[self.key_column] = SortedKeys(())
+        self.indices[self.key_column] = [{} for i in range(NUM_INDEX_SHARDS)]
 
-        self.lock.release()
+    # Replaces all indices with @indices, such as ones loaded from disk
+    def set_indices(self, indices):
+        for column, shards in enumerate(indices):
+            if shards == None:
+                self.sorted_keys[column] = None
+            else:
+                self.sorted_keys[column] = SortedKeys(chain.from_iterable(shards))
+        self.indices = indices
 
-        return res
+    # Returns True if a column is indexed and False otherwise
+    def is_indexed(self, column):
+        return self.indices[column] != None
 
     # Go through the primary key column and get all the mappings to base RIDs
     def get_all_base_rids(self):
-        self.lock.acquire()
-
-        if self.indices[self.table.key + DATA_COL_START] == None:
-            self.lock.release()
+        column = self.key_column
+        shards = self.indices[column]
+        if shards == None:
             return -1
 
         rids = []
-        for v in self.indices[self.table.key + DATA_COL_START].values():
-            rids += v
-
-        self.lock.release()
+        for i, shard in enumerate(shards):
+            with self.shard_locks[column][i]:
+                rids += chain.from_iterable(shard.values())
 
         return rids
 
     # Returns the RID of all records in a base page containing the value or
     # pointing to a tail record that contains the value
     def locate(self, column, value):
-        self.lock.acquire()
+        shards = self.indices[column]
+        if shards == None:
+            return -1
+
+        shard_num = hash(value) % NUM_INDEX_SHARDS
+        shard = shards[shard_num]
 
-        if self.indices[column] == None:
-            self.lock.release()
+        # Reject missing values without the lock, since checking membership
+        # in a dict is atomic and needs no copy
+        if value not in shard:
             return -1
 
-        rids = self.indices[column].get(value, -1)
+        with self.shard_locks[column][shard_num]:
+            rids = shard.get(value, -1)
+            if rids == -1:
+                return -1
+            # Return a copy since the RIDs may change once the lock is released
+            return list(rids)
+
+    # Returns True if @value is a key in the index of @column
+    # Checking membership in a dict is atomic, so no lock is needed
+    def contains(self, column, value):
+        shards = self.indices[column]
+        return shards != None and value in shards[hash(value) % NUM_INDEX_SHARDS]
+
+    # Returns one RID of a record containing @value, or -1 if there is none
+    # Meant for unique columns such as the primary key, where no list is needed
+    def locate_one(self, column, value):
+        shards = self.indices[column]
+        if shards == None:
+            return -1
 
-        self.lock.release()
+        shard_num = hash(value) % NUM_INDEX_SHARDS
+        shard = shards[shard_num]
+        if value not in shard:
+            return -1
 
-        return rids
+        with self.shard_locks[column][shard_num]:
+            for rid in shard.get(value, ()):
+                return rid
+            return -1
 
     # Returns the RID of all records in a base page containing a value within
     # the given range or pointing to a tail record that contains a value within range
     def locate_range(self, begin, end, column):
-        self.lock.acquire()
-
-        if self.indices[column] == None:
-            self.lock.release()
+        shards = self.indices[column]
+        sorted_keys = self.sorted_keys[column]
+        if shards == None or sorted_keys == None:
             return -1
 
+        # Only look up the keys that exist within the range
         rids = []
-        for i in range(begin, end + 1):
-            found_rids = self.indices[column].get(i, -1)
-            if found_rids == -1:
-                continue
-            for r in found_rids:
-                rids.append(r)
-
-        self.lock.release()
+        for key in sorted_keys.get_range(begin, end):
+            shard_num = hash(key) % NUM_INDEX_SHARDS
+            with self.shard_locks[column][shard_num]:
+                found_rids = shards[shard_num].get(key, -1)
+                if found_rids == -1:
+                    continue
+                rids += found_rids
 
         return rids
 
@@ -80,6 +205,7 @@ class Index:
         self.lock.acquire()
 
         self.indices[column_number] = None
+        self.sorted_keys[column_number] = None
 
         self.lock.release()
 
@@ -87,8 +213,9 @@ class Index:
     def create_index(self, column_number):
         self.lock.acquire()
 
-        # Index using a hash map: {data in column_number : RID}
-        self.indices[column_number] = {}
+        # Index using hash maps: {data in column_number : RID}
+        # Built as defaultdicts so each insertion is a single lookup
+        shards = [defaultdict(set) for i in range(NUM_INDEX_SHARDS)]
 
         # Go through every page range and look through every base page
         # Add the latest record's data in the given column to the hash map
@@ -99,104 +226,178 @@ class Index:
 
             # Add all column values in the base page to the hash map
             for bp_num in range(max_num_bp + 1):
-                rids_page = self.table.bufferpool.get_physical_page(
-                    self.table.name, pr_num, bp_num, RID_COLUMN
-                )
-                rids_page.pin_count += 1
-                self.__index_base_page_data(
-                    rids_page.data_to_int_array(), column_number
-                )
-                rids_page.pin_count -= 1
+                self.__index_base_page_data(pr_num, bp_num, column_number, shards)
+
+        # Publish the index once it is fully built
+        # Plain dicts are published so lookups of missing keys do not insert them
+        shards = [dict(shard) for shard in shards]
+        self.sorted_keys[column_number] = SortedKeys(chain.from_iterable(shards))
+        self.indices[column_number] = shards
 
         self.lock.release()
 
     # Helper function for create_index
-    # Maps the given column's data to a list of RIDs of base page records
+    # Maps the given column's data to a set of RIDs of base page records
     # Given a value, the index will return a list of RIDs of base page
     # records whose latest column has that value
-    def __index_base_page_data(self, rids, column_number):
+    def __index_base_page_data(self, pr_num, bp_num, column_number, shards):
+        bufferpool = self.table.bufferpool
+        table_name = self.table.name
+
+        # Decode the RID, indirection, and indexed columns of the whole base page at once
+        pages = [
+            bufferpool.get_physical_page(table_name, pr_num, bp_num, col)
+            for col in (RID_COLUMN, INDIRECTION_COLUMN, column_number)
+        ]
+        bufferpool.pin_physical_pages(pages)
+        num_records = pages[0].num_records
+        rids, indirections, base_vals = [p.read_vals(0, num_records) for p in pages]
+        tps = bufferpool.get_tps(table_name, pr_num, bp_num)
+        bufferpool.unpin_physical_pages(pages)
+
         # Go through the base page and add the latest record's data in the
         # given column to the index
-        for rid in rids:
-            col_val = self.table.get_latest_column_val(rid, column_number)
-            if col_val == None:
+        for rid, indirection, col_val in zip(rids, indirections, base_vals):
+            # Skip deleted records and ones that are still being inserted
+            if self.table.use_page_directory("r", rid, None) == -1:
                 continue
 
+            # Only records updated since the last merge need their tail record
+            if indirection != INDIRECTION_NULL and indirection > tps:
+                col_val = bufferpool.get_record_column_val(
+                    table_name, indirection, column_number
+                )
+
             # Add key and rid to the hash map
-            # If key isn't in the hash map, initialize it to be an array containing rid
-            if self.indices[column_number].get(col_val, -1) == -1:
-                self.indices[column_number][col_val] = [rid]
-            else:
-                self.indices[column_number][col_val].append(rid)
+            shards[hash(col_val) % NUM_INDEX_SHARDS][col_val].add(rid)
 
     # Given a column number, the old value, and the new value,
     # remove the mapping from the old value to the RID and add a mapping
     # from the new value to the RID provided that an index has
     # already been created on the column.
     def update_index(self, column_number, old_value, new_value, base_rid):
-        self.lock.acquire()
-
         # Check if index has been created yet and if primary key column has been indexed
         # Cannot proceed if at least one of these conditions is false
-        if (
-            self.indices[column_number] == None
-            or self.indices[self.table.key + DATA_COL_START] == None
-        ):
-            self.lock.release()
+        shards = self.indices[column_number]
+        if shards == None or self.indices[self.key_column] == None:
             return False
 
-        # Find RID of corresponding record in base page
-        # rid = self.indices[column_number].get(old_value, -1)
-        # if rid == -1:
-        #     return False
-        # rid = rid[0]
-
         # Remove the mapping from the old value to the RID and
         # add or create the new one if necessary
-        self.indices[column_number][old_value].remove(base_rid)
-        if len(self.indices[column_number][old_value]) == 0:
-            self.indices[column_number].pop(old_value)
+        self.__move_rid(column_number, shards, old_value, new_value, base_rid)
 
-        if self.indices[column_number].get(new_value, -1) == -1:
-            self.indices[column_number][new_value] = [base_rid]
-        else:
-            self.indices[column_number][new_value].append(base_rid)
+        return True
 
-        self.lock.release()
+    # Applies a batch of (<column number>, <old value>, <new value>, <base RID>)
+    # index updates for one record in a single call
+    # Values that did not change are skipped instead of being removed and re-added
+    def bulk_update(self, entries):
+        if self.indices[self.key_column] == None:
+            return False
+
+        for column_number, old_value, new_value, base_rid in entries:
+            shards = self.indices[column_number]
+            if shards == None or old_value == new_value:
+                continue
+            self.__move_rid(column_number, shards, old_value, new_value, base_rid)
 
         return True
 
-    # Deletes all indices given an array of possible keys and
-    # the RID of the corresponding base record
-    def delete_index(self, possible_keys, base_rid):
-        self.lock.acquire()
+    # Moves a RID from one key of a column's index to another
+    # If both keys hash to the same shard, its lock is only taken once
+    def __move_rid(self, column, shards, old_key, new_key, rid):
+        old_shard_num = hash(old_key) % NUM_INDEX_SHARDS
+        new_shard_num = hash(new_key) % NUM_INDEX_SHARDS
+        with self.shard_locks[column][old_shard_num]:
+            self.__remove_from_shard(column, shards[old_shard_num], old_key, rid)
+            if old_shard_num == new_shard_num:
+                self.__add_to_locked_shard(column, shards[new_shard_num], new_key, rid)
+                return
 
-        for i, key in enumerate(possible_keys):
+        self.__add_to_shard(column, shards, new_key, rid)
+
+    # Deletes all indices given the latest version of a record and
+    # the RID of the corresponding base record
+    # Only data columns are indexed, so the keys come straight from @record's columns
+    def delete_index(self, record, base_rid):
+        for i, key in enumerate(record.columns, DATA_COL_START):
             # Check if an index has been created on the column
-            if self.indices[i] != None:
+            shards = self.indices[i]
+            if shards == None:
+                continue
+
+            shard_num = hash(key) % NUM_INDEX_SHARDS
+            with self.shard_locks[i][shard_num]:
+                shard = shards[shard_num]
+
                 # Check if the key has been added to the index
-                list_of_rids = self.indices[i].get(key, -1)
-                if list_of_rids == -1:
+                set_of_rids = shard.get(key, -1)
+                if set_of_rids == -1:
                     continue
 
-                # Scan the list of RIDs for base_rid and remove if there's a match
-                for rid in list_of_rids:
-                    if base_rid == rid:
-                        list_of_rids.remove(base_rid)
-                        break
+                set_of_rids.discard(base_rid)
 
                 # Remove the mapping from key to RIDs if there are no RIDs to map to
-                if len(list_of_rids) == 0:
-                    self.indices[i].pop(key)
-
-        self.lock.release()
+                if len(set_of_rids) == 0:
+                    shard.pop(key)
+                    self.__remove_sorted_key(i, key)
 
     # Add a mapping from key to value
     def add(self, column, key, value):
-        if self.indices[column] == None:
+        shards = self.indices[column]
+        if shards == None:
             return False
 
-        if self.indices[column].get(key, -1) == -1:
-            self.indices[column][key] = [value]
-        else:
-            self.indices[column][key].append(value)
\ No newline at end of file
+        self.__add_to_shard(column, shards, key, value)
+
+    # Adds a mapping from key to value unless the key is already in the index
+    # The key is checked and added under its shard's lock, so of concurrent
+    # calls with the same key only one adds it
+    # Returns True if the mapping was added or the column is not indexed
+    def add_unique(self, column, key, value):
+        shards = self.indices[column]
+        if shards == None:
+            return True
+
+        shard_num = hash(key) % NUM_INDEX_SHARDS
+        with self.shard_locks[column][shard_num]:
+            shard = shards[shard_num]
+            if key in shard:
+                return False
+            self.__add_to_locked_shard(column, shard, key, value)
+        return True
+
+    # Adds a mapping from key to value in the shard the key hashes to
+    def __add_to_shard(self, column, shards, key, value):
+        shard_num = hash(key) % NUM_INDEX_SHARDS
+        with self.shard_locks[column][shard_num]:
+            self.__add_to_locked_shard(column, shards[shard_num], key, value)
+
+    # Adds a mapping from key to value in a shard whose lock is already held
+    def __add_to_locked_shard(self, column, shard, key, value):
+        num_keys = len(shard)
+        shard.setdefault(key, set()).add(value)
+
+        # A new key was added
+        if len(shard) != num_keys:
+            sorted_keys = self.sorted_keys[column]
+            if sorted_keys != None:
+                sorted_keys.add(key)
+
+    # Removes a mapping from key to value in a shard whose lock is already held
+    def __remove_from_shard(self, column, shard, key, value):
+        rids = shard.get(key, -1)
+        if rids == -1:
+            return
+        rids.discard(value)
+
+        # Remove the key if there are no RIDs to map to
+        if len(rids) == 0:
+            shard.pop(key)
+            self.__remove_sorted_key(column, key)
+
+    # Removes a key that is no longer in a column's index from its sorted keys
+    def __remove_sorted_key(self, column, key):
+        sorted_keys = self.sorted_keys[column]
+        if sorted_keys != None:
+            sorted_keys.remove(key)
\ No newline at end of file
@@ -1,115 +1,164 @@
+from lstore.config import NUM_LOCK_MANAGER_SHARDS
 import threading
 
 
 class LockManager:
     def __init__(self):
-        # Maps {<RID> : <list of tuples (<"S" or "X">, transaction id)>}
-        # "S": shared lock
-        # "X": exclusive lock
-        self.locks = {}
+        # Locks are split into NUM_LOCK_MANAGER_SHARDS shards picked by hashing the RID
+        # Each shard has its own latch so transactions locking different
+        # records do not wait on each other
 
-        # Maps {<transaction id> : <list of RIDs>}
-        self.lock_owners = {}
+        # Shared and exclusive locks are kept apart, so checking a record for an
+        # exclusive lock is a single lookup rather than a scan of its holders
+        # Maps each shard to {<RID> : <set of transaction ids holding a shared lock>}
+        self.shared_locks = [{} for i in range(NUM_LOCK_MANAGER_SHARDS)]
+        # Maps each shard to {<RID> : <transaction id holding an exclusive lock>}
+        # A record with an exclusive lock has no shared locks
+        self.exclusive_locks = [{} for i in range(NUM_LOCK_MANAGER_SHARDS)]
 
-        self.latch = threading.Lock()
+        # Maps each shard to {<transaction id> : <list of RIDs>}
+        self.lock_owners = [{} for i in range(NUM_LOCK_MANAGER_SHARDS)]
+
+        self.latches = [threading.Lock() for i in range(NUM_LOCK_MANAGER_SHARDS)]
 
     def print(self):
-        self.latch.acquire()
-        print(f"{threading.current_thread()}: {self.locks}")
-        self.latch.release()
+        for i in range(NUM_LOCK_MANAGER_SHARDS):
+            self.latches[i].acquire()
+        print(
+            f"{threading.current_thread()}: {self.shared_locks} {self.exclusive_locks}"
+        )
+        for i in range(NUM_LOCK_MANAGER_SHARDS):
+            self.latches[i].release()
 
     # Allow a shared lock to be aquired if there are no locks on the record
     # or the only locks on a record are shared locks
+    # No lock is granted unless all of them can be
     def acquire_shared_lock(self, keys, transaction_id):
-        self.latch.acquire()
-        for key in keys:
-            if self.locks.get(key, -1) == -1:
-                self.locks[key] = [("S", transaction_id)]
-                self.__add_lock_owner(key, transaction_id)
-                continue
-
-            already_has_lock = False
-            # Check for any exclusive locks on a record
-            for l in self.locks[key]:
-                # If the transaction already holds a lock (shared or exclusive),
-                # continue and do not downgrade the lock
-                if l[1] == transaction_id:
-                    already_has_lock = True
-                    break
-
-                # Reject a lock request if there is an exclusive lock on the record
-                # that is held by a different transaction
-                if l[0] == "X" and l[1] != transaction_id:
-                    self.latch.release()
+        keys_by_shard = self.__group_keys_by_shard(keys)
+        shard_nums = self.__acquire_latches(keys_by_shard)
+
+        # Reject a lock request if there is an exclusive lock on any record
+        # that is held by a different transaction
+        for shard_num in shard_nums:
+            exclusive_locks = self.exclusive_locks[shard_num]
+            for key in keys_by_shard[shard_num]:
+                holder = exclusive_locks.get(key, -1)
+                if holder != -1 and holder != transaction_id:
+                    self.__release_latches(shard_nums)
                     return False
 
-            if already_has_lock:
-                continue
-
-            # If there are no exclusive locks, grant the lock
-            self.locks[key].append(("S", transaction_id))
-            self.__add_lock_owner(key, transaction_id)
-
-        self.latch.release()
+        # Grant the locks
+        for shard_num in shard_nums:
+            shared_locks = self.shared_locks[shard_num]
+            exclusive_locks = self.exclusive_locks[shard_num]
+            for key in keys_by_shard[shard_num]:
+                # If the transaction already holds an exclusive lock,
+                # do not downgrade the lock
+                if exclusive_locks.get(key, -1) == transaction_id:
+                    continue
+
+                holders = shared_locks.setdefault(key, set())
+                if transaction_id not in holders:
+                    holders.add(transaction_id)
+                    self.__add_lock_owner(shard_num, key, transaction_id)
+
+        self.__release_latches(shard_nums)
         return True
 
     # Allow an exclusive lock to be aquired only if there are no locks on the record
+    # No lock is granted unless all of them can be
     def acquire_exclusive_lock(self, keys, transaction_id):
-        self.latch.acquire()
-        for key in keys:
-            # If there are no locks on the record, grant the lock
-            if self.locks.get(key, -1) == -1:
-                self.locks[key] = [("X", transaction_id)]
-                self.__add_lock_owner(key, transaction_id)
-                continue
-
-            # Check all the locks that are on the record
-            for i, l in enumerate(self.locks[key]):
-                # Stop checking the locks if the same transaction already holds an exclusive lock
-                if l[0] == "X" and l[1] == transaction_id:
-                    break
-
-                # Reject the request if there is a shared or exclusive lock
-                # held by another transaction
-                if l[1] != transaction_id:
-                    self.latch.release()
+        keys_by_shard = self.__group_keys_by_shard(keys)
+        shard_nums = self.__acquire_latches(keys_by_shard)
+
+        # Reject the request if there is a shared or exclusive lock on any record
+        # held by another transaction
+        for shard_num in shard_nums:
+            shared_locks = self.shared_locks[shard_num]
+            exclusive_locks = self.exclusive_locks[shard_num]
+            for key in keys_by_shard[shard_num]:
+                holder = exclusive_locks.get(key, -1)
+                if holder == transaction_id:
+                    continue
+
+                holders = shared_locks.get(key, -1)
+                if holder != -1 or (
+                    holders != -1
+                    and (len(holders) != 1 or transaction_id not in holders)
+                ):
+                    self.__release_latches(shard_nums)
                     return False
 
-                # Upgrade the shared lock to an exclusive lock if the shared lock is
-                # the only lock on the record
-                if l[0] == "S" and l[1] == transaction_id and len(self.locks[key]) == 1:
-                    self.locks[key][i] = ("X", transaction_id)
-
-        self.latch.release()
+        # Grant the locks
+        for shard_num in shard_nums:
+            shared_locks = self.shared_locks[shard_num]
+            exclusive_locks = self.exclusive_locks[shard_num]
+            for key in keys_by_shard[shard_num]:
+                if exclusive_locks.get(key, -1) == transaction_id:
+                    continue
+
+                # Upgrade the transaction's shared lock if it holds one
+                # since it is the only lock on the record
+                exclusive_locks[key] = transaction_id
+                if shared_locks.pop(key, -1) == -1:
+                    self.__add_lock_owner(shard_num, key, transaction_id)
+
+        self.__release_latches(shard_nums)
         return True
 
     # Removes all the locks held by a transaction
     def release_held_locks(self, transaction_id):
-        self.latch.acquire()
-
-        # Return if the transaction does not own any locks
-        if self.lock_owners.get(transaction_id, -1) == -1:
-            self.latch.release()
-            return
-
-        for lock in self.lock_owners[transaction_id]:
-            i = 0
-            while i < len(self.locks[lock]):
-                if self.locks[lock][i][1] == transaction_id:
-                    self.locks[lock].pop(i)
-                else:
-                    i += 1
-
-            # Remove the mapping in self.locks if there are no locks are on a record
-            if len(self.locks[lock]) == 0:
-                self.locks.pop(lock)
-
-        self.lock_owners.pop(transaction_id)
-        self.latch.release()
-
-    # Add a mapping <transaction_id> : <list of keys> to self.lock_owners
-    def __add_lock_owner(self, key, transaction_id):
-        if self.lock_owners.get(transaction_id, -1) == -1:
-            self.lock_owners[transaction_id] = [key]
+        for shard_num in range(NUM_LOCK_MANAGER_SHARDS):
+            # Skip shards where the transaction does not own any locks
+            # Only the transaction itself adds its entries, so this check
+            # cannot miss locks it owns
+            if transaction_id not in self.lock_owners[shard_num]:
+                continue
+
+            self.latches[shard_num].acquire()
+
+            shared_locks = self.shared_locks[shard_num]
+            exclusive_locks = self.exclusive_locks[shard_num]
+            for lock in self.lock_owners[shard_num].pop(transaction_id):
+                if exclusive_locks.get(lock, -1) == transaction_id:
+                    exclusive_locks.pop(lock)
+                    continue
+
+                holders = shared_locks[lock]
+                holders.discard(transaction_id)
+
+                # Remove the mapping if there are no shared locks on the record
+                if len(holders) == 0:
+                    shared_locks.pop(lock)
+
+            self.latches[shard_num].release()
+
+    # Returns {<shard number> : <list of keys in the shard>}
+    # Duplicate keys are only included once
+    def __group_keys_by_shard(self, keys):
+        keys_by_shard = {}
+        for key in set(keys):
+            shard_num = hash(key) % NUM_LOCK_MANAGER_SHARDS
+            keys_by_shard.setdefault(shard_num, []).append(key)
+        return keys_by_shard
+
+    # Acquires the latches of every shard in @keys_by_shard
+    # Latches are always acquired in increasing shard order to avoid deadlocks
+    # Returns the sorted shard numbers
+    def __acquire_latches(self, keys_by_shard):
+        shard_nums = sorted(keys_by_shard)
+        for shard_num in shard_nums:
+            self.latches[shard_num].acquire()
+        return shard_nums
+
+    def __release_latches(self, shard_nums):
+        for shard_num in shard_nums:
+            self.latches[shard_num].release()
+
+    # Add a mapping <transaction_id> : <list of keys> to the shard's lock owners
+    def __add_lock_owner(self, shard_num, key, transaction_id):
+        lock_owners = self.lock_owners[shard_num]
+        if lock_owners.get(transaction_id, -1) == -1:
+            lock_owners[transaction_id] = [key]
         else:
-            self.lock_owners[transaction_id].append(key)
\ No newline at end of file
+            lock_owners[transaction_id].append(key)
\ No newline at end of file
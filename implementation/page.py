@@ -7,55 +7,158 @@ from lstore.config import (
     RID_COLUMN,
     TIMESTAMP_COLUMN,
     SCHEMA_ENCODING_COLUMN,
-    PHYSICAL_PAGE_METADATA_SIZE,
     NUM_RECORDS_START,
     NUM_RECORDS_END,
     TPS_START,
     TPS_END,
     NUM_UPDATES_START,
     NUM_UPDATES_END,
+    DATA_START,
+    MAX_RECORDS_PER_PAGE,
 )
 from lstore.record import Record
 import threading
+import struct
+import functools
+
+# Packs and unpacks a config.COLUMN_SIZE byte signed integer in Big-Endian
+COLUMN_STRUCT = struct.Struct(">q")
+
+
+# Returns a precompiled struct that unpacks @count consecutive column values
+# Compiled once per count so decoding a whole column is a single C-level call
+@functools.lru_cache(maxsize=None)
+def get_column_array_struct(count):
+    return struct.Struct(">" + str(count) + "q")
+
+
+# Returns the schema encoding bit of each of @num_columns data columns
+# The first column is the most significant bit
+@functools.lru_cache(maxsize=None)
+def get_schema_bits(num_columns):
+    return tuple(1 << i for i in range(num_columns - 1, -1, -1))
+
+
+# Returns the schema encoding of an update, with the bit of every column set
+# whose value in @columns is not None and differs from @updated_columns
+def get_updated_schema(columns, updated_columns):
+    return sum(
+        bit
+        for bit, column, updated_column in zip(
+            get_schema_bits(len(columns)), columns, updated_columns
+        )
+        if column != None and column != updated_column
+    )
+
+
+# Returns a function that writes a record into a page with @num_columns columns
+# The function is generated once per column count with the writes to each
+# physical page unrolled, so no loop or PhysicalPage.write call is needed
+@functools.lru_cache(maxsize=None)
+def get_page_writer(num_columns):
+    values = [
+        "record.indirection",
+        "record.rid",
+        "int(record.timestamp)",
+        "record.schema_encoding",
+    ]
+    values += ["data_values[" + str(i) + "]" for i in range(num_columns - 4)]
+
+    lines = [
+        "def write(page, record, offset):",
+        "    start = DATA_START + COLUMN_SIZE * offset",
+        "    columns = page.columns",
+        "    data_values = record.columns",
+    ]
+    for i, value in enumerate(values):
+        lines += [
+            "    p = columns[" + str(i) + "]",
+            "    with p.lock:",
+            "        pack_into(p.data, start, " + value + ")",
+            "        p.is_dirty = True",
+        ]
+
+    namespace = {
+        "DATA_START": DATA_START,
+        "COLUMN_SIZE": COLUMN_SIZE,
+        "pack_into": COLUMN_STRUCT.pack_into,
+    }
+    exec("\n".join(lines), namespace)
+    return namespace["write"]
 
 
 class Page:
+    __slots__ = ("columns",)
+
     def __init__(self, num_columns):
         self.columns = [PhysicalPage() for i in range(num_columns)]
 
     def write(self, record: Record, offset):
-        max_offset = (PAGE_SIZE - PHYSICAL_PAGE_METADATA_SIZE) // COLUMN_SIZE - 1
-        if offset <= max_offset:
-            # Write metadata
-            self.columns[INDIRECTION_COLUMN].write(record.indirection, offset)
-            self.columns[RID_COLUMN].write(record.rid, offset)
-            self.columns[TIMESTAMP_COLUMN].write(int(record.timestamp), offset)
-            self.columns[SCHEMA_ENCODING_COLUMN].write(
-                int.from_bytes(record.schema_encoding[0:], "big", signed=True), offset
-            )
-
-            # Write data
-            for i, value in enumerate(record.columns, start=4):
-                self.columns[i].write(value, offset)
+        if offset < MAX_RECORDS_PER_PAGE:
+            # Write the metadata and data columns
+            get_page_writer(len(self.columns))(self, record, offset)
+
+    # Atomically reserves the next offset in every column of the page
+    # Returns -1 if the page is full
+    def reserve_slot(self):
+        first = self.columns[0]
+        with first.num_records_lock:
+            offset = first.num_records
+            if offset >= MAX_RECORDS_PER_PAGE:
+                return -1
+            for p in self.columns:
+                p.num_records = offset + 1
+        return offset
+
+    # Reserves the next offset like reserve_slot, and calls @allocate_rid for the
+    # RID of the record written there while the offset is still being reserved
+    # RIDs then increase with offsets within the page and from one page to the next
+    # Returns (<offset>, <RID>), or (-1, -1) if the page is full
+    def reserve_slot_and_rid(self, allocate_rid):
+        first = self.columns[0]
+        with first.num_records_lock:
+            offset = first.num_records
+            if offset >= MAX_RECORDS_PER_PAGE:
+                return -1, -1
+            rid = allocate_rid()
+            for p in self.columns:
+                p.num_records = offset + 1
+        return offset, rid
+
+    # Returns the values of every column of the record at @offset
+    def read_row(self, offset):
+        start = DATA_START + COLUMN_SIZE * offset
+        return [COLUMN_STRUCT.unpack_from(p.data, start)[0] for p in self.columns]
 
     def get_rids_in_page(self):
         rids = self.columns[RID_COLUMN].data_to_int_array()
         return rids
 
-    # Returns a copy of all of the Page's columns
-    def create_copy(self):
-        copied_columns = []
-        for i in range(len(self.columns)):
-            p = PhysicalPage()
-            p.num_records = self.columns[i].use_num_records("r")
-            p.tps = self.columns[i].get_tps()
-            p.num_updates = self.columns[i].get_num_updates()
-            p.data = self.columns[i].get_data().copy()
-            copied_columns.append(p)
-        return copied_columns
+    # Makes @page a copy of this Page, reusing @page's physical pages
+    def copy_into(self, page):
+        for copied_column, column in zip(page.columns, self.columns):
+            copied_column.copy_from(column)
 
 
 class PhysicalPage:
+    # Fixed attribute slots make attribute access on the hot read and write
+    # paths cheaper and shrink every page object
+    # __weakref__ lets the bufferpool cache pages in a WeakValueDictionary
+    __slots__ = (
+        "num_records",
+        "tps",
+        "num_updates",
+        "data",
+        "is_dirty",
+        "pin_count",
+        "lock",
+        "num_records_lock",
+        "fill_lock",
+        "is_filled",
+        "is_evicted",
+        "__weakref__",
+    )
+
     def __init__(self):
         self.num_records = 0
         self.tps = 0
@@ -66,17 +169,41 @@ class PhysicalPage:
         self.is_dirty = False
         self.pin_count = 0
 
+        # Guards writes to self.data and the pin count
+        # Only writers take it, since reads of single fields and values are atomic
         self.lock = threading.Lock()
+        # Guards self.num_records, which has its own lock since it is
+        # incremented while other threads write to the page
         self.num_records_lock = threading.Lock()
 
+        # Held by the bufferpool while the page's data is being read from disk
+        self.fill_lock = threading.Lock()
+        self.is_filled = True
+
+        # Set by the bufferpool once the page is no longer in the bufferpool
+        self.is_evicted = False
+
+    # Makes this physical page a copy of @source
+    # @source's data is copied into this page's own buffer, so no buffer is
+    # allocated and later changes to @source do not show up in the copy
+    def copy_from(self, source):
+        self.num_records = source.use_num_records("r")
+        self.tps = source.get_tps()
+        self.num_updates = source.get_num_updates()
+        self.data[:] = source.get_data()
+        self.is_dirty = False
+
     # "p": (pre)read then increment
     # "w": write (increment) then read
     # "r": read
     def use_num_records(self, operation):
+        # Reading is a single load, so it does not need the lock
+        if operation == "r":
+            return self.num_records
+
         self.num_records_lock.acquire()
 
-        max_records = (PAGE_SIZE - PHYSICAL_PAGE_METADATA_SIZE) // COLUMN_SIZE
-        if self.num_records >= max_records:
+        if self.num_records >= MAX_RECORDS_PER_PAGE:
             self.num_records_lock.release()
             return False
 
@@ -88,16 +215,11 @@ class PhysicalPage:
         elif operation == "w":
             self.num_records += 1
             res = self.num_records
-        elif operation == "r":
-            res = self.num_records
         self.num_records_lock.release()
         return res
 
     def get_dirty_bit(self):
-        self.lock.acquire()
-        res = self.is_dirty
-        self.lock.release()
-        return res
+        return self.is_dirty
 
     def use_pin_count(self, operation):
         self.lock.acquire()
@@ -114,98 +236,78 @@ class PhysicalPage:
         return res
 
     def get_tps(self):
-        self.lock.acquire()
-        res = self.tps
-        self.lock.release()
-        return res
+        return self.tps
 
     def get_num_updates(self):
-        self.lock.acquire()
-        res = self.num_updates
-        self.lock.release()
-        return res
+        return self.num_updates
 
     def get_data(self):
-        self.lock.acquire()
-        res = self.data
-        self.lock.release()
-        return res
+        return self.data
 
     def has_capacity(self):
-        self.lock.acquire()
-        max_records = (PAGE_SIZE - PHYSICAL_PAGE_METADATA_SIZE) // COLUMN_SIZE
-        res = self.num_records < max_records
-
-        self.lock.release()
-
-        return res
+        return self.num_records < MAX_RECORDS_PER_PAGE
 
     # Appends @value as a config.COLUMN_SIZE byte integer in Big-Endian to self.data
     # Returns true if write is successful and false otherwise
     def write(self, value, offset):
-        max_records = (PAGE_SIZE - PHYSICAL_PAGE_METADATA_SIZE) // COLUMN_SIZE
-
-        if offset >= max_records:
+        self.lock.acquire()
+        if offset >= MAX_RECORDS_PER_PAGE:
             self.lock.release()
             return False
 
-        start = (COLUMN_SIZE * offset) + PHYSICAL_PAGE_METADATA_SIZE
-        end = (COLUMN_SIZE * (offset + 1)) + PHYSICAL_PAGE_METADATA_SIZE
-        self.data[start:end] = value.to_bytes(COLUMN_SIZE, "big", signed=True)
-
-        # Update metadata for number of records
-        self.data[NUM_RECORDS_START:NUM_RECORDS_END] = self.num_records.to_bytes(
-            COLUMN_SIZE, "big", signed=True
-        )
-        # Update metadata for TPS of base page
-        self.data[TPS_START:TPS_END] = self.tps.to_bytes(
-            COLUMN_SIZE, "big", signed=True
-        )
-        # Update metadata for number of updates of the base page
-        self.data[NUM_UPDATES_START:NUM_UPDATES_END] = self.num_updates.to_bytes(
-            COLUMN_SIZE, "big", signed=True
-        )
+        # Pack directly into the page's buffer without creating temporary bytes
+        # The page's metadata is written by flush_metadata before the page is persisted
+        COLUMN_STRUCT.pack_into(self.data, DATA_START + COLUMN_SIZE * offset, value)
         self.is_dirty = True
+        self.lock.release()
 
         return offset
 
-    def read_val(self, offset):
-        self.lock.acquire()
-
-        start = (COLUMN_SIZE * offset) + PHYSICAL_PAGE_METADATA_SIZE
-        end = (COLUMN_SIZE * (offset + 1)) + PHYSICAL_PAGE_METADATA_SIZE
-        val = int.from_bytes(self.data[start:end], "big", signed=True)
+    # Writes the number of records into the page's metadata
+    # Called by the bufferpool right before the page is written to disk
+    # TPS and number of updates are always set directly in self.data by the bufferpool
+    def flush_metadata(self):
+        num_records = self.num_records
+        if COLUMN_STRUCT.unpack_from(self.data, NUM_RECORDS_START)[0] != num_records:
+            COLUMN_STRUCT.pack_into(self.data, NUM_RECORDS_START, num_records)
 
-        self.lock.release()
-        return val
+    def read_val(self, offset):
+        # Unpacking from the bytearray is atomic, so the read does not need the lock
+        start = DATA_START + COLUMN_SIZE * offset
+        return COLUMN_STRUCT.unpack_from(self.data, start)[0]
 
     def change_val(self, new_val, offset):
         self.lock.acquire()
 
-        start = (COLUMN_SIZE * offset) + PHYSICAL_PAGE_METADATA_SIZE
-        end = (COLUMN_SIZE * (offset + 1)) + PHYSICAL_PAGE_METADATA_SIZE
-        self.data[start:end] = new_val.to_bytes(COLUMN_SIZE, "big", signed=True)
+        COLUMN_STRUCT.pack_into(self.data, DATA_START + COLUMN_SIZE * offset, new_val)
 
         self.lock.release()
 
-    def data_to_int_array(self):
+    # Copies values from the physical page @source into this page
+    # @offsets is a list of (<offset in source>, <offset in this page>) pairs
+    # Both pages' values are viewed as 8 byte words, so each copy is a single
+    # load and store with no slicing, and values are never decoded from Big-Endian
+    def copy_vals(self, source, offsets):
         self.lock.acquire()
 
-        int_data = []
-        for i in range(self.num_records):
-            start = (COLUMN_SIZE * i) + PHYSICAL_PAGE_METADATA_SIZE
-            end = (COLUMN_SIZE * (i + 1)) + PHYSICAL_PAGE_METADATA_SIZE
+        values = memoryview(self.data)[DATA_START:].cast("q")
+        source_values = memoryview(source.data)[DATA_START:].cast("q")
+        for source_offset, offset in offsets:
+            values[offset] = source_values[source_offset]
+        values.release()
+        source_values.release()
 
-            data = int.from_bytes(
-                self.data[start:end],
-                "big",
-                signed=True,
-            )
+        self.lock.release()
 
-            int_data.append(data)
+    # Returns the @count consecutive values starting at @offset
+    def read_vals(self, offset, count):
+        start = DATA_START + COLUMN_SIZE * offset
+        return list(get_column_array_struct(count).unpack_from(self.data, start))
 
-        self.lock.release()
-        return int_data
+    # Decoding is a single unpack_from call, which never observes a partly
+    # written value, so readers do not wait on writers for the lock
+    def data_to_int_array(self):
+        return self.read_vals(0, self.num_records)
 
 
 class PageRange:
@@ -246,29 +348,21 @@ class PageRange:
             return True
         return False
 
+    # Returns the corresponding base or tail page of a page number
+    def get_page(self, page_num):
+        if self.page_is_base_page(page_num):
+            return self.base_pages[page_num]
+        return self.tail_pages[page_num - MAX_BASE_PAGES]
+
     # Returns the metadata of a record given a page number, offset, and the column index
     def get_record_column_val(self, page_num, offset, column_num):
-        page = None
+        page = self.get_page(page_num)
 
-        # Get the corresponding base or tail page
-        if self.page_is_base_page(page_num):
-            page = self.base_pages[page_num]
-        else:
-            page = self.tail_pages[page_num - MAX_BASE_PAGES]
-
-        # Use the offset to find the starting and ending point of the data in
-        # the bytearray stored by the physical page
-        data_start_index = offset * COLUMN_SIZE + PHYSICAL_PAGE_METADATA_SIZE
-        data_end_index = (
-            (offset * COLUMN_SIZE) + COLUMN_SIZE + PHYSICAL_PAGE_METADATA_SIZE
-        )
-
-        data = int.from_bytes(
-            page.columns[column_num].data[data_start_index:data_end_index],
-            "big",
-            signed=True,
-        )
-        return data
+        # Decode the value in place rather than slicing the physical page's bytearray
+        data_start_index = DATA_START + COLUMN_SIZE * offset
+        return COLUMN_STRUCT.unpack_from(
+            page.columns[column_num].data, data_start_index
+        )[0]
 
     def get_indirection_val(self, page_num, offset):
         return self.get_record_column_val(page_num, offset, INDIRECTION_COLUMN)
@@ -276,29 +370,14 @@ class PageRange:
     # Returns a Record object given page number and offset
     # Note that this approach assumes that data is cumulative
     def get_record(self, page_num, offset):
-        # Find all metadata values first
-        metadata_columns = [
-            INDIRECTION_COLUMN,
-            RID_COLUMN,
-            TIMESTAMP_COLUMN,
-            SCHEMA_ENCODING_COLUMN,
-        ]
-        metadata = []
-        for col in metadata_columns:
-            metadata.append(self.get_record_column_val(page_num, offset, col))
-
-        # Find all corresponding data values
-        # num_columns is the same for base and tail pages
-        num_columns = len(self.base_pages[0].columns)
-        columns = []
-        for i in range(DATA_COL_START, num_columns):
-            value = self.get_record_column_val(page_num, offset, i)
-            columns.append(value)
+        # Read the metadata and data values of the record in one pass
+        values = self.get_page(page_num).read_row(offset)
 
         # Create record object
-        record = Record(metadata[RID_COLUMN], 0, columns)
-        record.indirection = metadata[INDIRECTION_COLUMN]
-        record.timestamp = metadata[TIMESTAMP_COLUMN]
-        record.schema_encoding = metadata[SCHEMA_ENCODING_COLUMN]
+        record = Record(
+            values[RID_COLUMN], 0, values[DATA_COL_START:], values[TIMESTAMP_COLUMN]
+        )
+        record.indirection = values[INDIRECTION_COLUMN]
+        record.schema_encoding = values[SCHEMA_ENCODING_COLUMN]
 
         return record
\ No newline at end of file
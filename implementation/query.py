@@ -1,4 +1,3 @@
-from concurrent.futures import ThreadPoolExecutor
 from lstore.table import Table
 from lstore.record import Record
 from lstore.index import Index
@@ -12,8 +11,10 @@ from lstore.config import (
     MERGE_CONDITION,
     CREATE_INDICES_CONDITION,
     TIMESTAMP_COLUMN,
+    PARALLEL_SELECT_THRESHOLD,
 )
-import threading
+from itertools import repeat
+from functools import partial
 
 
 class Query:
@@ -26,9 +27,10 @@ class Query:
 
     def __init__(self, table):
         self.table = table
-        self.insert_lock = threading.Lock()
-        self.update_lock = threading.Lock()
-        self.create_updated_record_lock = threading.Lock()
+        # Index of the primary key column within a record
+        self.key_column = DATA_COL_START + table.key
+        # Allocates the RID of a new record
+        self.allocate_rid = partial(table.use_num_records, "p")
         pass
 
     """
@@ -40,31 +42,23 @@ class Query:
 
     def delete(self, primary_key):
         # Indices for primary key should exist already
-        if not self.table.index.is_indexed(DATA_COL_START + self.table.key):
-            self.table.index.create_index(DATA_COL_START + self.table.key)
+        if not self.table.index.is_indexed(self.key_column):
+            self.table.index.create_index(self.key_column)
 
         # Check if the RID exists
         # Get the RID of the base page with the primary key
-        rid = self.table.index.locate(DATA_COL_START + self.table.key, primary_key)
+        rid = self.table.index.locate_one(self.key_column, primary_key)
         if rid == -1:
             return False
-        rid = rid[0]
 
-        # Save the latest record for deleting the index on it later
+        # Remove the latest version of the record from the index
         latest_record = self.table.get_latest_record(rid)
+        self.table.index.delete_index(latest_record, rid)
 
-        # First RID is of a record in base page
-        indirection_val = self.table.delete_record(rid)
-
+        # Delete the base record and its tail records
         # num_records in Table class can't be decremented or else
         # future records added/updated will potentially have common RIDs
-
-        # Loops until the record's indirection_column has no value or if current record is base record
-        while indirection_val != INDIRECTION_NULL and indirection_val != rid:
-            # The indirection_val are RIDs of records in tail page
-            indirection_val = self.table.delete_record(indirection_val)
-
-        self.table.index.delete_index(latest_record.to_array(), rid)
+        self.table.delete_chain(rid)
         return True
 
     """
@@ -74,20 +68,11 @@ class Query:
     """
 
     def insert(self, *columns):
-        self.insert_lock.acquire()
-
         # Check if the record to insert has a non-unique primary key
-        if self.table.index.is_indexed(DATA_COL_START + self.table.key):
-            inserted_primary_key = columns[self.table.key]
-
-            # Check if primary key already exists, return False if it does
-            rids = self.table.index.locate(
-                DATA_COL_START + self.table.key, inserted_primary_key
-            )
-
-            if rids != -1:
-                self.insert_lock.release()
-                return False
+        # Return False if the primary key already exists
+        # This only rejects duplicates early, the key is claimed atomically below
+        if self.table.index.contains(self.key_column, columns[self.table.key]):
+            return False
 
         num_records = 0
         if len(columns) > self.table.num_columns:
@@ -96,55 +81,35 @@ class Query:
         else:
             num_records = self.table.use_num_records("p")
 
-        schema_encoding = "0" * self.table.total_num_columns
         record = Record(num_records, columns[0], columns)
-        page_range_num = self.table.use_num_page_ranges("r")
-        bp_num = 0
-        offset = 0
-
-        # Initialize page directory and index and create a page range and base page
-        if page_range_num == 0:
-            page_range_num = self.table.bufferpool.create_page_range(self.table.name)
-            self.table.bufferpool.insert_base_page(self.table.name, page_range_num)
-            self.table.use_page_directory("w", record.rid, (page_range_num, 0, 0))
 
-            self.table.index.create_index(DATA_COL_START + self.table.key)
-        else:
-            # Check if latest page range has capacity
-            page_range_num = self.table.use_num_page_ranges("r") - 1
-
-            # Make a new page range if it doesn't have capacity
-            if not self.table.bufferpool.page_range_has_capacity(
-                self.table.name, page_range_num
-            ):
-                page_range_num = self.table.bufferpool.create_page_range(
-                    self.table.name
-                )
-                self.table.bufferpool.insert_base_page(self.table.name, page_range_num)
-
-            # Check if latest base page in the latest page range has capacity
+        # Loops until an offset is reserved in a base page with capacity
+        while True:
+            page_range_num = self.__get_insert_page_range()
             bp_num = self.table.bufferpool.get_highest_base_page_num(
                 self.table.name, page_range_num
             )
-            phys_page = self.table.bufferpool.get_physical_page(
-                self.table.name, page_range_num, bp_num, 0
-            )
-
-            if not self.table.bufferpool.page_has_capacity(
-                self.table.name, page_range_num, bp_num
-            ):
-                self.table.bufferpool.insert_base_page(self.table.name, page_range_num)
-                bp_num += 1
 
-        base_page = self.table.bufferpool.get_page(
-            self.table.name, page_range_num, bp_num
-        )
-        self.table.bufferpool.pin_page(base_page)
-        offset = base_page.columns[0].num_records
-        for p in base_page.columns:
-            p.num_records += 1
-
-        self.insert_lock.release()
+            # Fast path: claim a slot in the latest base page without any lock
+            if bp_num != -1:
+                base_page = self.table.bufferpool.get_page(
+                    self.table.name, page_range_num, bp_num
+                )
+                self.table.bufferpool.pin_page(base_page)
+                offset = base_page.reserve_slot()
+                if offset != -1:
+                    break
+                self.table.bufferpool.unpin_page(base_page)
+
+            # Slow path: the base page is full, so add one unless another insert
+            # already did (a full page range makes the next iteration open a new one)
+            with self.table.get_page_range_lock(page_range_num):
+                if bp_num == self.table.bufferpool.get_highest_base_page_num(
+                    self.table.name, page_range_num
+                ):
+                    self.table.bufferpool.insert_base_page(
+                        self.table.name, page_range_num
+                    )
 
         # Insertion
         base_page.write(record, offset)
@@ -156,9 +121,19 @@ class Query:
             (page_range_num, bp_num, offset),
         )
 
+        # Claim the primary key in the index in a single step, so of two
+        # concurrent inserts of the same key only one succeeds
+        # The other one's record is deleted again
+        if not self.table.index.add_unique(
+            self.key_column, columns[self.table.key], record.rid
+        ):
+            self.table.delete_record(record.rid)
+            self.table.bufferpool.unpin_page(base_page)
+            return False
+
         # Update index
         for i, col in enumerate(columns):
-            if self.table.index.is_indexed(i + DATA_COL_START):
+            if i != self.table.key and self.table.index.is_indexed(i + DATA_COL_START):
                 # Create a new mapping from a data value to the base record's RID
                 self.table.index.add(i + DATA_COL_START, col, record.rid)
 
@@ -196,50 +171,54 @@ class Query:
     def select_version(
         self, search_key, search_key_index, projected_columns_index, relative_version
     ):
+        search_column = search_key_index + DATA_COL_START
+        index = self.table.index
+
+        # projected_columns_index is an array of 1s and 0s
+        # Positions of the projected columns, computed once for every record
+        projected = [i for i, num in enumerate(projected_columns_index) if num == 1]
+
         # Create indices when a threshold for number of records is reached
-        if self.table.index.indices[search_key_index + DATA_COL_START] == None:
+        if not index.is_indexed(search_column):
             if self.table.num_records % CREATE_INDICES_CONDITION == 0:
-                self.table.index.create_index(search_key_index + DATA_COL_START)
+                index.create_index(search_column)
             else:
                 # Scan through base records if there is no index
-                records = self.table.scan(
-                    search_key, search_key_index + DATA_COL_START, relative_version
-                )
+                records = self.table.scan(search_key, search_column, relative_version)
 
-                res = []
                 for r in records:
-                    column_return = []
-                    for i, num in enumerate(projected_columns_index):
-                        if num == 1:
-                            column_return.append(r.columns[i])
-                    r.columns = column_return
-                    res.append(r)
-                return res
-
-        rids = self.table.index.indices[search_key_index + DATA_COL_START].get(
-            search_key, -1
-        )
+                    columns = r.columns
+                    r.columns = [columns[i] for i in projected]
+                return records
+
+        rids = index.locate(search_column, search_key)
 
         # If the key is not found, return an empty list
         if rids == -1:
             return []
 
-        records = []
+        # Records of different RIDs are independent, so many of them are fetched
+        # concurrently, in the same order as the RIDs
+        get_record_version = self.table.get_record_version
+        if len(rids) > PARALLEL_SELECT_THRESHOLD:
+            fetched_records = self.table.select_executor.map(
+                get_record_version, rids, repeat(relative_version)
+            )
+        else:
+            fetched_records = [
+                get_record_version(rid, relative_version) for rid in rids
+            ]
 
-        for rid in rids:
-            column_return = []  # Consists of the projected columns only
-            record = self.table.get_record_version(rid, relative_version)
+        records = []
 
+        for record in fetched_records:
             # If record does not exist, ignore it
             if record == None:
                 continue
 
-            # projected_columns_index is an array of 1s and 0s
-            for i, num in enumerate(projected_columns_index):
-                if num == 1:
-                    column_return.append(record.columns[i])
-
-            record.columns = column_return
+            # Keep the projected columns only
+            columns = record.columns
+            record.columns = [columns[i] for i in projected]
             records.append(record)
 
         return records
@@ -252,48 +231,42 @@ class Query:
 
     def update(self, primary_key, *columns):
         # Check if update doesn't actually update anything (columns is all None)
-        num_none = 0
-        for c in columns:
-            if c == None:
-                num_none += 1
-        if num_none == len(columns):
+        if all(c == None for c in columns):
             return True
 
-        rids = self.table.index.locate(DATA_COL_START + self.table.key, primary_key)
+        rids = self.table.index.locate_one(self.key_column, primary_key)
 
         # Return True and don't do an update if the primary key does not exist
         if rids == -1:
             return True
 
         # Check if the update changes the primary key column to an existing primary key
-        if columns[self.table.key] != None and columns[self.table.key] != primary_key:
-            updated_primary_key = columns[self.table.key]
-
-            # Check if primary key already exists, return False if it does
-            rid = self.table.index.locate(
-                DATA_COL_START + self.table.key, updated_primary_key
-            )
-            if rid != -1:
-                return False
-        rids = rids[0]
+        # Return False if it does
+        updated_primary_key = columns[self.table.key]
+        if (
+            updated_primary_key != None
+            and updated_primary_key != primary_key
+            and self.table.index.contains(self.key_column, updated_primary_key)
+        ):
+            return False
 
-        prev_record = self.table.get_latest_record(rids)
+        prev_rid, prev_columns = self.table.get_latest_rid_and_columns(rids)
 
         base_record_indirection = self.table.bufferpool.get_record_column_val(
             self.table.name, rids, INDIRECTION_COLUMN
         )
 
         # Create updated tail record's columns (updates are cumulative)
-        updated_cols = prev_record.columns.copy()
-        for i in range(len(columns)):
-            if columns[i] != None:
-                updated_cols[i] = columns[i]
+        # Built in one pass, since prev_columns is still needed below
+        updated_cols = [
+            prev if c == None else c for prev, c in zip(prev_columns, columns)
+        ]
         updated_record = Record(-1, primary_key, updated_cols)
 
         # Insert a copy of the record in the base page if it is being updated
         # for the first time
         if base_record_indirection == INDIRECTION_NULL:
-            base_copy = Record(-1, primary_key, prev_record.columns)
+            base_copy = Record(-1, primary_key, prev_columns)
             base_copy.indirection = rids
             self.__insert_to_tail_page(rids, [], base_copy)
 
@@ -301,9 +274,9 @@ class Query:
             # tail page
             updated_record.indirection = base_copy.rid
         else:
-            updated_record.indirection = prev_record.rid
+            updated_record.indirection = prev_rid
 
-        self.__insert_to_tail_page(rids, prev_record.columns, updated_record)
+        self.__insert_to_tail_page(rids, prev_columns, updated_record)
         return True
 
     """
@@ -331,21 +304,35 @@ class Query:
     def sum_version(
         self, start_range, end_range, aggregate_column_index, relative_version
     ):
-        total = 0
-        found_records = 0
-
-        for key in range(start_range, end_range + 1):  # include end_range
-            # Check if key exists
-            rid = self.table.index.indices[DATA_COL_START + self.table.key].get(key, -1)
-            if rid != -1:
-                # Add column to total
-                total += self.table.get_record_column_version(
-                    rid[0], relative_version, aggregate_column_index + DATA_COL_START
-                )
-                found_records += 1
+        use_page_directory = self.table.use_page_directory
+        get_record_column_version = self.table.get_record_column_version
+        aggregate_column = aggregate_column_index + DATA_COL_START
+
+        # The sorted primary keys give the keys that exist in the range directly,
+        # instead of probing the index for every integer in it
+        rids = self.table.index.locate_range(start_range, end_range, self.key_column)
+        if rids == -1:
+            return False
+
+        # Collect the location of every base record in the range in one pass
+        located_rids = []
+        for rid in rids:
+            location = use_page_directory("r", rid, None)
+            if location != -1:
+                located_rids.append((location, rid))
 
-        if found_records == 0:
+        if len(located_rids) == 0:
             return False
+
+        # Read the records in storage order so consecutive reads stay on the
+        # same base page instead of jumping between pages
+        located_rids.sort()
+
+        total = 0
+        for location, rid in located_rids:
+            # Add column to total
+            total += get_record_column_version(rid, relative_version, aggregate_column)
+
         return total
 
     """
@@ -358,56 +345,69 @@ class Query:
     """
 
     def increment(self, key, column):
-        r = self.select(key, self.table.key, [1] * self.table.num_columns)[0]
-        if r is not False:
-            updated_columns = [None] * self.table.num_columns
-            updated_columns[column] = r.columns[column] + 1
-            u = self.update(key, *updated_columns)
-            return u
-        return False
+        # Only the incremented column is read, instead of selecting the whole record
+        rid = self.table.index.locate_one(self.key_column, key)
+        if rid == -1:
+            return False
 
-    # Helper function to add records to a tail page and perform
-    # the necessary additional updates
-    def __insert_to_tail_page(self, base_rid, columns, updated_record):
-        self.update_lock.acquire()
-        base_page_range_num, base_page_num, offset = self.table.use_page_directory(
-            "r", base_rid, None
-        )
+        value = self.table.get_latest_column_val(rid, column + DATA_COL_START)
+        if value == None:
+            return False
 
-        updated_record.rid = self.table.use_num_records("p")
+        updated_columns = [None] * self.table.num_columns
+        updated_columns[column] = value + 1
+        return self.update(key, *updated_columns)
 
-        # Check if latest tail page has capacity, if it doesn't, make a new tail page
-        tail_page_num = self.table.bufferpool.get_highest_tail_page_num(
-            self.table.name, base_page_range_num
-        )
-        if (
-            tail_page_num == MAX_BASE_PAGES - 1
-            or not self.table.bufferpool.page_has_capacity(
-                self.table.name, base_page_range_num, tail_page_num
-            )
+    # Returns the latest page range, creating a new one if the latest is full
+    def __get_insert_page_range(self):
+        page_range_num = self.table.use_num_page_ranges("r") - 1
+        if page_range_num != -1 and self.table.bufferpool.page_range_has_capacity(
+            self.table.name, page_range_num
         ):
-            self.table.bufferpool.insert_tail_page(self.table.name, base_page_range_num)
-            tail_page_num += 1
+            return page_range_num
 
-        # Get the tail page from the bufferpool
-        tail_page = self.table.bufferpool.get_page(
-            self.table.name, base_page_range_num, tail_page_num
-        )
-        self.table.bufferpool.pin_page(tail_page)
+        with self.table.page_range_creation_lock:
+            # Returns the latest page range if another insert already created one
+            page_range_num = self.table.bufferpool.create_page_range(self.table.name)
 
-        offset = tail_page.columns[0].num_records
-        for p in tail_page.columns:
-            p.num_records += 1
+        return page_range_num
 
-        num_updates = self.table.bufferpool.get_num_updates(
-            self.table.name, base_page_range_num, base_page_num
-        )
-        self.table.bufferpool.set_num_updates(
-            self.table.name, base_page_range_num, base_page_num, num_updates + 1
-        )
-        num_updates += 1
+    # Helper function to add records to a tail page and perform
+    # the necessary additional updates
+    def __insert_to_tail_page(self, base_rid, columns, updated_record):
+        base_location = self.table.use_page_directory("r", base_rid, None)
+        base_page_range_num, base_page_num, base_offset = base_location
+        page_range_lock = self.table.get_page_range_lock(base_page_range_num)
+
+        # Loops until an offset is reserved in a tail page with capacity
+        # The tail record's RID is allocated with its offset, so TIDs increase
+        # within and across tail pages as the merge expects
+        while True:
+            tail_page_num = self.table.bufferpool.get_highest_tail_page_num(
+                self.table.name, base_page_range_num
+            )
 
-        self.update_lock.release()
+            # Fast path: claim a slot in the latest tail page without any lock
+            if tail_page_num != MAX_BASE_PAGES - 1:
+                tail_page = self.table.bufferpool.get_page(
+                    self.table.name, base_page_range_num, tail_page_num
+                )
+                self.table.bufferpool.pin_page(tail_page)
+                offset, updated_record.rid = tail_page.reserve_slot_and_rid(
+                    self.allocate_rid
+                )
+                if offset != -1:
+                    break
+                self.table.bufferpool.unpin_page(tail_page)
+
+            # Slow path: make a new tail page unless another update already did
+            with page_range_lock:
+                if tail_page_num == self.table.bufferpool.get_highest_tail_page_num(
+                    self.table.name, base_page_range_num
+                ):
+                    self.table.bufferpool.insert_tail_page(
+                        self.table.name, base_page_range_num
+                    )
 
         # Insert tail record
         tail_page.write(updated_record, offset)
@@ -419,24 +419,24 @@ class Query:
             [base_page_range_num, tail_page_num, offset],
         )
 
-        # Update base record's indirection to point to new tail record
-        self.table.change_indirection(updated_record.rid, base_rid)
-
-        # Update base record's schema encoding column
-        old_schema = self.table.bufferpool.get_record_column_val(
-            self.table.name, base_rid, SCHEMA_ENCODING_COLUMN
-        )
-
-        self.table.update_schema_encoding(
-            base_rid, old_schema, columns, updated_record.columns
+        # Update base record's number of updates, indirection and schema encoding
+        num_updates = self.table.bufferpool.base_record_post_update(
+            self.table.name,
+            base_location,
+            updated_record.rid,
+            columns,
+            updated_record.columns,
         )
+        self.table.latest_tail[base_rid] = updated_record.rid
 
         # Update index
-        for i, col in enumerate(columns):
-            if col != None and self.table.index.is_indexed(i + DATA_COL_START):
-                self.table.index.update_index(
-                    i + DATA_COL_START, col, updated_record.columns[i], base_rid
-                )
+        index_updates = [
+            (i + DATA_COL_START, col, updated_record.columns[i], base_rid)
+            for i, col in enumerate(columns)
+            if col != None and self.table.index.is_indexed(i + DATA_COL_START)
+        ]
+        if len(index_updates) > 0:
+            self.table.index.bulk_update(index_updates)
 
         self.table.bufferpool.unpin_page(tail_page)
 
@@ -447,8 +447,6 @@ class Query:
                 self.table.name, base_page_range_num, base_page_num
             ):
                 self.table.add_to_merge_queue((base_page_range_num, base_page_num))
-                pool = ThreadPoolExecutor(1)
-                pool.submit(self.table.merge)
 
         return True
 
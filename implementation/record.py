@@ -3,11 +3,18 @@ from time import time
 
 
 class Record:
-    def __init__(self, rid, key, columns):
+    # Records are created for every select and update, so fixed attribute slots
+    # keep them small and cheap to build
+    __slots__ = ("indirection", "rid", "timestamp", "schema_encoding", "key", "columns")
+
+    # @timestamp is None for new records, which are stamped with the current time
+    # Records read back from pages pass their stored timestamp instead
+    def __init__(self, rid, key, columns, timestamp=None):
         self.indirection = INDIRECTION_NULL
         self.rid = rid
-        self.timestamp = time()
-        self.schema_encoding = bytearray(len(columns))
+        self.timestamp = time() if timestamp == None else timestamp
+        # Bitmask of the updated columns, as stored in the schema encoding column
+        self.schema_encoding = 0
         self.key = key
         self.columns = columns
 
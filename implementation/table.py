@@ -1,6 +1,7 @@
-from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 from lstore.index import Index
-from lstore.page import Page
+from lstore.page import Page, COLUMN_STRUCT, get_updated_schema
 from lstore.lock_manager import LockManager
 from lstore.bufferpool import Bufferpool
 from lstore.record import Record
@@ -9,15 +10,18 @@ from lstore.config import (
     INDIRECTION_NULL,
     INDIRECTION_COLUMN,
     RID_COLUMN,
-    COLUMN_SIZE,
     MAX_BASE_PAGES,
     SCHEMA_ENCODING_COLUMN,
     DATA_COL_START,
-    PHYSICAL_PAGE_METADATA_SIZE,
     TPS_START,
-    TPS_END,
+    NUM_SELECT_WORKERS,
+    NUM_PAGE_DIRECTORY_SHARDS,
+    MERGE_PAGE_POOL_SIZE,
 )
+import itertools
 import threading
+import queue
+import traceback
 
 
 class Table:
@@ -33,99 +37,160 @@ class Table:
         self.key = key
         self.num_columns = num_columns
         self.total_num_columns = num_columns + NUM_METADATA_COLS
-        self.page_directory = {}
+        # The page directory maps {<RID> : (<page range #>, <page #>, <offset>)}
+        # It is split into shards picked by RID, each with its own lock
+        self.page_directory_shards = [{} for i in range(NUM_PAGE_DIRECTORY_SHARDS)]
         self.num_page_ranges = 0
         self.page_ranges_metadata = []
+        # Maps {<base RID> : <latest tail RID>} for records updated since the table
+        # was opened, so their latest version is found without reading indirection
+        # Updates to one record are serialized by its exclusive lock, and single
+        # dict operations are atomic, so this needs no lock
+        self.latest_tail = {}
         self.index = Index(self)
+        # Number of RIDs handed out, which is also the next RID
         self.num_records = 0
         self.bufferpool = bufferpool
-        self.merge_queue = deque()
         self.lock_manager = LockManager()
-        self.num_transactions = 0
+        # Transaction IDs start at 1
+        self.transaction_counter = itertools.count(1)
 
         # Locks
+        # The transaction counter needs none, since next() on an itertools.count
+        # is atomic
         self.num_records_lock = threading.Lock()
-        self.page_directory_lock = threading.Lock()
-        self.num_transactions_lock = threading.Lock()
-        self.num_page_ranges_lock = threading.Lock()
-        self.merge_queue_lock = threading.Lock()
-
-    # Getter and setter for self.num_records
+        self.page_directory_locks = [
+            threading.Lock() for i in range(NUM_PAGE_DIRECTORY_SHARDS)
+        ]
+        # Serializes creating new page ranges
+        self.page_range_creation_lock = threading.Lock()
+        # Maps {<page range number> : <Lock>} guarding page allocation in that range
+        self.page_range_locks = {}
+
+        # Holds (<page range #>, <base page #>) tuples of base pages to merge
+        # A background thread blocks on it until a base page is added
+        self.merge_queue = queue.Queue()
+        # Copies of merged base pages, kept so merges do not allocate new pages
+        self.merge_page_pool = queue.LifoQueue(maxsize=MERGE_PAGE_POOL_SIZE)
+        self.merge_thread = threading.Thread(target=self.merge, daemon=True)
+        self.merge_thread.start()
+        # Fetches the records of selects that match many RIDs, kept apart from
+        # the merge worker so selects never wait behind a merge
+        self.select_executor = ThreadPoolExecutor(max_workers=NUM_SELECT_WORKERS)
+
+    # Getter and setter for the number of records
     # "p": (pre)read then increment
     # "w": write (increment) then read
     # "r": read
+    # Both "p" and "w" hand out one RID. Reading is a single load, so it does not
+    # need the lock
     def use_num_records(self, operation):
-        self.num_records_lock.acquire()
+        if operation == "r":
+            return self.num_records
+
         res = -1
-        if operation == "p":
-            res = self.num_records
-            self.num_records += 1
-        elif operation == "w":
-            self.num_records += 1
-            res = self.num_records
-        elif operation == "r":
-            res = self.num_records
-        self.num_records_lock.release()
+        with self.num_records_lock:
+            if operation == "p":
+                res = self.num_records
+                self.num_records += 1
+            elif operation == "w":
+                self.num_records += 1
+                res = self.num_records
         return res
 
-    # Getter and setter for self.num_transactions
+    # Restarts the number of records at @num_records, such as when a table is opened
+    def set_num_records(self, num_records):
+        self.num_records = num_records
+
+    # Returns a new transaction ID given "w"
     def use_num_transactions(self, operation):
-        self.num_transactions_lock.acquire()
         res = -1
-
         if operation == "w":
-            self.num_transactions += 1
-            res = self.num_transactions
-        elif operation == "r":
-            res = self.num_transactions
-        self.num_transactions_lock.release()
+            res = next(self.transaction_counter)
         return res
 
-    # Getter and setter for self.page_directory
+    # Getter and setter for the page directory
+    # Reads take no lock, since a single dict lookup is atomic and never observes
+    # a partly applied write. Writers to a shard are serialized by its lock
     def use_page_directory(self, operation, key, value):
-        self.page_directory_lock.acquire()
+        shard_num = key % NUM_PAGE_DIRECTORY_SHARDS
+        page_directory = self.page_directory_shards[shard_num]
+        if operation == "r":
+            return page_directory.get(key, -1)
+
+        lock = self.page_directory_locks[shard_num]
+        lock.acquire()
         res = -1
 
         if operation == "w":
-            self.page_directory[key] = value
+            page_directory[key] = value
             res = value
-        elif operation == "r":
-            res = self.page_directory.get(key, -1)
         elif operation == "d":
-            self.page_directory.pop(key)
+            page_directory.pop(key)
             res = True
 
-        self.page_directory_lock.release()
+        lock.release()
         return res
 
-    def use_num_page_ranges(self, operation):
-        self.num_page_ranges_lock.acquire()
+    # Replaces the page directory with the entries of @page_directory
+    def set_page_directory(self, page_directory):
+        shards = [{} for i in range(NUM_PAGE_DIRECTORY_SHARDS)]
+        for rid, location in page_directory.items():
+            shards[rid % NUM_PAGE_DIRECTORY_SHARDS][rid] = location
+        self.page_directory_shards = shards
 
+    # Page ranges are only added while page_range_creation_lock is held, so the
+    # count has a single writer at a time and reading it needs no lock
+    def use_num_page_ranges(self, operation):
         res = -1
         if operation == "w":
             self.num_page_ranges += 1
             res = self.num_page_ranges
         elif operation == "r":
             res = self.num_page_ranges
-
-        self.num_page_ranges_lock.release()
         return res
 
+    # Returns the lock guarding page and offset allocation in the given page range
+    def get_page_range_lock(self, page_range_num):
+        lock = self.page_range_locks.get(page_range_num)
+        if lock == None:
+            lock = self.page_range_locks.setdefault(page_range_num, threading.Lock())
+        return lock
+
     def add_to_merge_queue(self, value):
-        self.merge_queue_lock.acquire()
-        self.merge_queue.append(value)
-        self.merge_queue_lock.release()
+        self.merge_queue.put(value)
 
+    # Runs on self.merge_thread for the lifetime of the table
+    # Waits until there is something in the merge queue and merges it
     def merge(self):
-        # Background thread that will continuously execute the merge
-        # Will keep waiting until there is something in the merge queue
-        # self.merge_queue will hold tuples: (page_range_num, base_page_num)
-        while len(self.merge_queue) > 0:
-            page_range_num, base_page_num = self.merge_queue[0]
-            self.__merge_helper(page_range_num, base_page_num)
-            self.merge_queue.popleft()
+        while True:
+            page_range_num, base_page_num = self.merge_queue.get()
+            try:
+                self.__merge_helper(page_range_num, base_page_num)
+            except Exception:
+                # A failed merge leaves the base page as it was, so it is not
+                # retried. Report it and keep the thread alive for later merges,
+                # since Database.close waits for all of them to be done
+                traceback.print_exc()
+            finally:
+                self.merge_queue.task_done()
 
     def __merge_helper(self, page_range_num, base_page_num):
+        # Get all relevant tail pages (all tail pages that are full)
+        max_tp_num = self.bufferpool.get_highest_tail_page_num(
+            self.name, page_range_num
+        )
+        if self.bufferpool.page_has_capacity(self.name, page_range_num, max_tp_num):
+            max_tp_num -= 1
+            if max_tp_num == MAX_BASE_PAGES - 1:
+                return
+
+        # Skip the merge if every full tail page is already merged into the base page
+        # This only reads the TPS and the last TID, so the base page is not copied
+        tps = self.bufferpool.get_tps(self.name, page_range_num, base_page_num)
+        if self.bufferpool.peek_max_tid(self.name, page_range_num, max_tp_num) <= tps:
+            return
+
         # Get current base page of record being updated
         # Page will be in main memory instead of the bufferpool
         original_base_page = self.bufferpool.get_page_no_add(
@@ -133,9 +198,12 @@ class Table:
         )
         self.bufferpool.pin_page(original_base_page)
 
-        # Create a copy of the base page
-        base_page = Page(0)
-        base_page.columns = original_base_page.create_copy()
+        # Create a copy of the base page, reusing a page left by an earlier merge
+        try:
+            base_page = self.merge_page_pool.get_nowait()
+        except queue.Empty:
+            base_page = Page(len(original_base_page.columns))
+        original_base_page.copy_into(base_page)
 
         # Get the rids of all the base records in the base_page
         rids = base_page.get_rids_in_page()
@@ -149,23 +217,21 @@ class Table:
         num_updates = 0
         max_tid = 0
 
-        # Get all relevant tail pages (all tail pages that are full)
-        max_tp_num = self.bufferpool.get_highest_tail_page_num(
-            self.name, page_range_num
-        )
-        if self.bufferpool.page_has_capacity(self.name, page_range_num, max_tp_num):
-            max_tp_num -= 1
-            if max_tp_num == MAX_BASE_PAGES - 1:
-                return
-
         # Loop from most recently full tail page to least recently full tail page
         current_tp_num = max_tp_num
         while current_tp_num >= MAX_BASE_PAGES:
             tail_page = self.bufferpool.get_page_no_add(
-                self.name, page_range_num, max_tp_num
+                self.name, page_range_num, current_tp_num
             )
             tids = tail_page.get_rids_in_page()
 
+            # Slots are reserved before their records are written, so a full tail
+            # page can still have records being written. Merge later instead of
+            # raising the TPS past records that are not written yet
+            if not self.__is_tail_page_written(page_range_num, current_tp_num, tids):
+                self.bufferpool.unpin_page(original_base_page)
+                return
+
             max_tid = max(tids[0], max_tid)
 
             # The smallest TID will be the first TID in the array since TIDs are in
@@ -173,17 +239,21 @@ class Table:
             if tids[0] < base_page.columns[RID_COLUMN].tps:
                 break
 
+            # Decode the primary keys of the whole tail page at once
+            primary_keys = tail_page.columns[self.key + NUM_METADATA_COLS].read_vals(
+                0, len(tids)
+            )
+
+            # (<tail offset>, <base offset>) of the latest update to each base record
+            offsets = []
+
             # Iterate backwards since the latest updates are at the end of the array
             for i in range(len(tids) - 1, -1, -1):
                 max_tid = max(tids[i], max_tid)
 
-                # Get the primary key of the ith entry
-                primary_key = tail_page.columns[self.key + NUM_METADATA_COLS].read_val(
-                    i
+                base_rid = self.index.locate_one(
+                    self.key + NUM_METADATA_COLS, primary_keys[i]
                 )
-                base_rid = self.index.locate(self.key + NUM_METADATA_COLS, primary_key)[
-                    0
-                ]
 
                 # If the corresponding base record is not in the base page being merged
                 # or the base record is already updated, continue looping
@@ -194,13 +264,16 @@ class Table:
                     continue
 
                 # Otherwise the latest update to the base record has been found
-                # Get the offset of the base record and
-                # copy the latest tail record's data values to the base record
+                updated_rids[base_rid] = True
                 pr_num, page_num, offset = self.use_page_directory("r", base_rid, None)
+                offsets.append((i, offset))
+
+            # Copy the latest tail records' data values to the base records
+            # one column at a time
+            if len(offsets) > 0:
                 for j in range(DATA_COL_START, len(tail_page.columns)):
-                    latest_col_val = tail_page.columns[j].read_val(offset)
-                    base_page.columns[j].change_val(latest_col_val, offset)
-                num_updates += 1
+                    base_page.columns[j].copy_vals(tail_page.columns[j], offsets)
+                num_updates += len(offsets)
 
             # Stop merging if everything has been updated
             if num_updates == base_page.columns[0].num_records:
@@ -211,7 +284,7 @@ class Table:
         # Update TPS to be the greatest TID
         if max_tid > base_page.columns[RID_COLUMN].tps:
             phys_page = base_page.columns[RID_COLUMN]
-            phys_page.data[TPS_START:TPS_END] = max_tid.to_bytes(COLUMN_SIZE, "big")
+            COLUMN_STRUCT.pack_into(phys_page.data, TPS_START, max_tid)
 
             base_page.columns[RID_COLUMN].tps = max_tid
 
@@ -222,109 +295,224 @@ class Table:
 
         self.bufferpool.unpin_page(original_base_page)
 
+        try:
+            self.merge_page_pool.put_nowait(base_page)
+        except queue.Full:
+            pass
+
+    # Returns True if every record in a tail page is written, given its TIDs
+    # A record is written once its page directory entry points to its offset
+    # Deleted records have their TID set to INDIRECTION_NULL
+    def __is_tail_page_written(self, page_range_num, tail_page_num, tids):
+        for offset, tid in enumerate(tids):
+            if tid == INDIRECTION_NULL:
+                continue
+
+            location = self.use_page_directory("r", tid, None)
+            if location == -1:
+                return False
+
+            pr_num, page_num, record_offset = location
+            if (
+                pr_num != page_range_num
+                or page_num != tail_page_num
+                or record_offset != offset
+            ):
+                return False
+        return True
+
     # Returns a Record object containing the latest record
     # given an RID of a record in a base page
     def get_latest_record(self, rid):
         return self.get_record_version(rid, 0)
 
+    # Returns (<RID>, <data columns>) of the latest version of a base record
+    # without building a Record object, or None if it is not a base record
+    def get_latest_rid_and_columns(self, rid):
+        location = self.use_page_directory("r", rid, None)
+        if location == -1:
+            return None
+        page_range_num, page_num, offset = location
+        if page_num >= MAX_BASE_PAGES:
+            return None
+
+        # The base record is the latest version if it was never updated or if
+        # its updates are merged, otherwise its indirection is the latest tail record
+        tail_rid = self.latest_tail.get(rid, -1)
+        if tail_rid != -1:
+            rid = tail_rid
+            page_range_num, page_num, offset = self.use_page_directory("r", rid, None)
+        else:
+            indirection = self.bufferpool.get_record_column_val(
+                self.name, rid, INDIRECTION_COLUMN
+            )
+            tps = self.bufferpool.get_tps(self.name, page_range_num, page_num)
+            if indirection != INDIRECTION_NULL and indirection > tps:
+                rid = indirection
+                page_range_num, page_num, offset = self.use_page_directory(
+                    "r", rid, None
+                )
+
+        page = self.bufferpool.get_page(self.name, page_range_num, page_num)
+        return rid, page.read_row(offset)[DATA_COL_START:]
+
     # Returns a Record object in the corresponding version
     # given an RID of a record in a base page
     def get_record_version(self, rid, version):
         # Check if the RID exists
-        if self.page_directory.get(rid, -1) == -1:
+        location = self.use_page_directory("r", rid, None)
+        if location == -1:
             return None
 
         # Check if the RID is of a record in the base page
-        base_page_range_num, base_page_num, base_offset = self.page_directory[rid]
+        base_page_range_num, base_page_num, base_offset = location
         if base_page_num >= MAX_BASE_PAGES:
             return None
 
-        # If indirection is less than TPS, return the record in the base page
-        indirection = self.bufferpool.get_record_column_val(
-            self.name, rid, INDIRECTION_COLUMN
-        )
-        tps = self.bufferpool.get_tps(self.name, base_page_range_num, base_page_num)
+        version_rid = self.__get_version_rid(rid, version, location)
+        if version_rid == rid:
+            return self.bufferpool.get_record_at(
+                self.name, base_page_range_num, base_page_num, base_offset
+            )
+        return self.bufferpool.get_record(self.name, version_rid)
+
+    # Returns the RID of the record holding @version of the base record @rid
+    # That is @rid itself if the base record holds it
+    # @location is the base record's page directory entry
+    def __get_version_rid(self, rid, version, location):
+        # The latest version of an updated record is its latest tail record
+        if version == 0:
+            tail_rid = self.latest_tail.get(rid, -1)
+            if tail_rid != -1:
+                return tail_rid
+
+        # If indirection is less than TPS, the base record holds every version
+        page_range_num, page_num, offset = location
+        indirection = self.bufferpool.get_physical_page(
+            self.name, page_range_num, page_num, INDIRECTION_COLUMN
+        ).read_val(offset)
+        tps = self.bufferpool.get_tps(self.name, page_range_num, page_num)
         if indirection <= tps:
-            return self.bufferpool.get_record(self.name, rid)
+            return rid
+
+        # If indirection is null, the base record was never updated
+        if indirection == INDIRECTION_NULL:
+            return rid
 
-        # Starts at record in base page (version 0 aka latest record
-        # is not in base page if it has been updated)
-        # Loops until desired version is found
-        while version <= 0:
-            # Get the current record's indirection value
+        # Version 0 aka latest record is the tail record the base record points to,
+        # and each older version is one more step along the tail records' indirection
+        base_rid = rid
+        rid = indirection
+        for i in range(-version):
             indirection = self.bufferpool.get_record_column_val(
                 self.name, rid, INDIRECTION_COLUMN
             )
 
-            # If indirection is null, the first update of the base page has been reached
-            # Return the base record
-            if indirection == INDIRECTION_NULL:
+            # The copy of the base record in the tail page points back to the base
+            # record, so it is the oldest version
+            if indirection == INDIRECTION_NULL or indirection == base_rid:
                 break
-
-            # Follow the indirection to the next record
             rid = indirection
-            version += 1
 
-        return self.bufferpool.get_record(self.name, rid)
+        return rid
 
     def delete_record(self, rid):
         # Check if the RID exists
-        if self.use_page_directory("r", rid, None) == -1:
+        location = self.use_page_directory("r", rid, None)
+        if location == -1:
             return None
 
         # Check if the RID is of a record in the base page
-        page_range_num, page_num, offset = self.use_page_directory("r", rid, None)
+        page_range_num, page_num, offset = location
         rid_page = self.bufferpool.get_physical_page(
             self.name, page_range_num, page_num, RID_COLUMN
         )
-        rid_page.pin_count += 1
+        self.bufferpool.pin_physical_pages([rid_page])
 
         # Accesses the RID of the record and sets it to INDIRECTION_NULL
         rid_page.change_val(INDIRECTION_NULL, offset)
-        # rid_page.data[
-        #     COLUMN_SIZE * offset
-        #     + PHYSICAL_PAGE_METADATA_SIZE : COLUMN_SIZE * (offset + 1)
-        #     + PHYSICAL_PAGE_METADATA_SIZE
-        # ] = INDIRECTION_NULL.to_bytes(COLUMN_SIZE, "big")
 
         # Get the value in the indirection column
-        indirection_val = self.bufferpool.get_record_column_val(
-            self.name, rid, INDIRECTION_COLUMN
-        )
+        indirection_val = self.bufferpool.get_physical_page(
+            self.name, page_range_num, page_num, INDIRECTION_COLUMN
+        ).read_val(offset)
 
         # Remove RID from page_directory
         self.use_page_directory("d", rid, None)
 
         rid_page.is_dirty = True
-        rid_page.pin_count -= 1
+        self.bufferpool.unpin_physical_pages([rid_page])
 
         return indirection_val
 
+    # Deletes a base record and every record in its tail chain
+    # Returns False if the base record does not exist
+    def delete_chain(self, base_rid):
+        # Walk the chain first, reading each record's indirection once
+        # Maps {(<page range #>, <page #>) : [(<RID>, <offset>)]}
+        records_by_page = {}
+        rid = base_rid
+        while True:
+            location = self.use_page_directory("r", rid, None)
+            if location == -1:
+                break
+            page_range_num, page_num, offset = location
+            records = records_by_page.setdefault((page_range_num, page_num), [])
+            records.append((rid, offset))
+
+            indirection_page = self.bufferpool.get_physical_page(
+                self.name, page_range_num, page_num, INDIRECTION_COLUMN
+            )
+            rid = indirection_page.read_val(offset)
+
+            # Stop at the end of the chain or once it wraps back to the base record
+            if rid == INDIRECTION_NULL or rid == base_rid:
+                break
+
+        if len(records_by_page) == 0:
+            return False
+        self.latest_tail.pop(base_rid, None)
+
+        # Set the RIDs to INDIRECTION_NULL page by page, so each RID page is
+        # fetched and pinned once no matter how many of its records are deleted
+        for (page_range_num, page_num), records in records_by_page.items():
+            rid_page = self.bufferpool.get_physical_page(
+                self.name, page_range_num, page_num, RID_COLUMN
+            )
+            self.bufferpool.pin_physical_pages([rid_page])
+            for rid, offset in records:
+                rid_page.change_val(INDIRECTION_NULL, offset)
+
+                # Remove RID from page_directory
+                self.use_page_directory("d", rid, None)
+
+            rid_page.is_dirty = True
+            self.bufferpool.unpin_physical_pages([rid_page])
+
+        return True
+
     def change_indirection(self, tail_rid, base_rid):
         # Check if the base record RID exists
-        if self.use_page_directory("r", base_rid, None) == -1:
+        location = self.use_page_directory("r", base_rid, None)
+        if location == -1:
             return False
 
         # Check if the RID is of a record in the base page
-        page_range_num, page_num, offset = self.use_page_directory("r", base_rid, None)
+        page_range_num, page_num, offset = location
         base_page_indirection = None
         if page_num < MAX_BASE_PAGES:
             base_page_indirection = self.bufferpool.get_physical_page(
                 self.name, page_range_num, page_num, INDIRECTION_COLUMN
             )
-            base_page_indirection.pin_count += 1
+            self.bufferpool.pin_physical_pages([base_page_indirection])
         else:
             return False
 
         base_page_indirection.change_val(tail_rid, offset)
-        # base_page_indirection.data[
-        #     COLUMN_SIZE * offset
-        #     + PHYSICAL_PAGE_METADATA_SIZE : COLUMN_SIZE * (offset + 1)
-        #     + PHYSICAL_PAGE_METADATA_SIZE
-        # ] = tail_rid.to_bytes(COLUMN_SIZE, "big")
+        self.latest_tail[base_rid] = tail_rid
 
         base_page_indirection.is_dirty = True
-        base_page_indirection.pin_count -= 1
+        self.bufferpool.unpin_physical_pages([base_page_indirection])
 
         return True
 
@@ -333,39 +521,29 @@ class Table:
             return True
 
         # Check if the base record RID exists
-        if self.use_page_directory("r", base_rid, None) == -1:
+        location = self.use_page_directory("r", base_rid, None)
+        if location == -1:
             return False
 
         # Check if the RID is of a record in the base page
-        page_range_num, page_num, offset = self.use_page_directory("r", base_rid, None)
+        page_range_num, page_num, offset = location
         base_page_schema_encoding = None
-        if page_range_num < MAX_BASE_PAGES:
+        if page_num < MAX_BASE_PAGES:
             base_page_schema_encoding = self.bufferpool.get_physical_page(
                 self.name, page_range_num, page_num, SCHEMA_ENCODING_COLUMN
             )
-            base_page_schema_encoding.pin_count += 1
+            self.bufferpool.pin_physical_pages([base_page_schema_encoding])
         else:
             return False
 
         # Change the corresponding bit to a 1 if a column is updated
-        new_schema = 0
-        for i in range(self.num_columns):
-            new_schema <<= 1
-            if columns[i] != None and columns[i] != updated_cols[i]:
-                new_schema |= 1
-
         # Bitwise or with the old schema to include the previous columns that were updated
-        new_schema |= old_schema
+        new_schema = get_updated_schema(columns, updated_cols) | old_schema
 
         base_page_schema_encoding.change_val(new_schema, offset)
-        # base_page_schema_encoding.data[
-        #     COLUMN_SIZE * offset
-        #     + PHYSICAL_PAGE_METADATA_SIZE : COLUMN_SIZE * (offset + 1)
-        #     + PHYSICAL_PAGE_METADATA_SIZE
-        # ] = new_schema.to_bytes(COLUMN_SIZE, "big")
 
         base_page_schema_encoding.is_dirty = True
-        base_page_schema_encoding.pin_count -= 1
+        self.bufferpool.unpin_physical_pages([base_page_schema_encoding])
 
         return True
 
@@ -378,43 +556,17 @@ class Table:
     # Same logic as get_record_version
     def get_record_column_version(self, rid, version, column):
         # Check if the RID exists
-        if self.use_page_directory("r", rid, None) == -1:
+        location = self.use_page_directory("r", rid, None)
+        if location == -1:
             return None
 
         # Check if the RID is of a record in the base page
-        base_page_range_num, base_page_num, base_offset = self.use_page_directory(
-            "r", rid, None
-        )
+        base_page_range_num, base_page_num, base_offset = location
         if base_page_num >= MAX_BASE_PAGES:
             return None
 
-        # If indirection is less than TPS, return the record in the base page
-        indirection = self.bufferpool.get_record_column_val(
-            self.name, rid, INDIRECTION_COLUMN
-        )
-        tps = self.bufferpool.get_tps(self.name, base_page_range_num, base_page_num)
-        if indirection <= tps:
-            return self.bufferpool.get_record_column_val(self.name, rid, column)
-
-        # Starts at record in base page (version 0 aka latest record
-        # is not in base page if it has been updated)
-        # Loops until desired version is found
-        while version <= 0:
-            # Get the current record's indirection value
-            indirection = self.bufferpool.get_record_column_val(
-                self.name, rid, INDIRECTION_COLUMN
-            )
-
-            # If indirection is null, the first update of the base page has been reached
-            # Return the base record's column
-            if indirection == INDIRECTION_NULL:
-                break
-
-            # Follow the indirection to the next record
-            rid = indirection
-            version += 1
-
-        return self.bufferpool.get_record_column_val(self.name, rid, column)
+        version_rid = self.__get_version_rid(rid, version, location)
+        return self.bufferpool.get_record_column_val(self.name, version_rid, column)
 
     # Scans through all base pages looking for all records of the given version
     # that have a given value in a given column
@@ -425,27 +577,66 @@ class Table:
         for pr_num in range(self.use_num_page_ranges("r")):
             # Look through all base pages in a page range
             for bp_num in range(self.page_ranges_metadata[pr_num][1] + 1):
-                base_page_rids = self.bufferpool.get_physical_page(
-                    self.name, pr_num, bp_num, RID_COLUMN
-                )
-                base_page_rids.pin_count += 1
+                base_page = self.bufferpool.get_page(self.name, pr_num, bp_num)
+                self.bufferpool.pin_page(base_page)
+
+                # Decode the RID, indirection and searched columns of the whole page
+                # at once instead of fetching every value through the page directory
+                num_records = base_page.columns[RID_COLUMN].num_records
+                rids, indirections, col_vals = [
+                    base_page.columns[col].read_vals(0, num_records)
+                    for col in (RID_COLUMN, INDIRECTION_COLUMN, column_num)
+                ]
+                tps = self.bufferpool.get_tps(self.name, pr_num, bp_num)
 
                 # Check if the column matches the search key, if it does
                 # get and add the entire record to the result
-                rids = base_page_rids.data_to_int_array()
-                for r in rids:
-                    col_val = self.get_record_column_version(r, version, column_num)
-                    if col_val == search_key:
-                        records.append(self.get_record_version(r, version))
-
-                base_page_rids.pin_count -= 1
+                for offset, (r, indirection, col_val) in enumerate(
+                    zip(rids, indirections, col_vals)
+                ):
+                    # Skip deleted records
+                    if r == INDIRECTION_NULL:
+                        continue
+
+                    # The base value is the value of every version if the record
+                    # was never updated or its updates are merged, otherwise
+                    # the record holding the version is found once and both the
+                    # value and the whole record are read from it
+                    version_rid = r
+                    if indirection != INDIRECTION_NULL and indirection > tps:
+                        version_rid = self.__get_version_rid(
+                            r, version, (pr_num, bp_num, offset)
+                        )
+                        col_val = self.bufferpool.get_record_column_val(
+                            self.name, version_rid, column_num
+                        )
+
+                    if col_val != search_key:
+                        continue
+
+                    # Records still being inserted are not in the page directory
+                    location = self.use_page_directory("r", r, None)
+                    if location != (pr_num, bp_num, offset):
+                        continue
+
+                    if version_rid == r:
+                        record = self.bufferpool.get_record_at(
+                            self.name, pr_num, bp_num, offset
+                        )
+                    else:
+                        record = self.bufferpool.get_record(self.name, version_rid)
+                    records.append(record)
+
+                self.bufferpool.unpin_page(base_page)
 
         return records
 
     # Debug function
     def print_page_directory(self):
-        for key in self.page_directory.keys():
-            page_range, page_num, offset = self.page_directory[key]
+        for key, location in chain.from_iterable(
+            shard.items() for shard in self.page_directory_shards
+        ):
+            page_range, page_num, offset = location
 
             record = page_range.get_record(page_num, offset)
 
@@ -35,7 +35,11 @@ class Transaction:
     """
 
     def add_query(self, query, table, *args):
-        self.queries.append([query, args])
+        # Arguments are kept as a list so inserts can append their RID in place
+        # The query is classified once here, since retries of an aborted
+        # transaction lock the same records again
+        get_rids, is_exclusive = self.__get_lock_handler(query)
+        self.queries.append([query, list(args), get_rids, is_exclusive])
         self.table = table
 
         # Initialize transaction ID
@@ -56,7 +60,7 @@ class Transaction:
             return -1
 
         # All locks have been acquired, perform the queries
-        for query, args in self.queries:
+        for query, args, get_rids, is_exclusive in self.queries:
             # Abort if there are integrity constraints
             if not query(*args):
                 self.abort()
@@ -77,40 +81,56 @@ class Transaction:
         return True
 
     def __acquire_all_locks(self):
-        # Acquire all locks first
-        for i, query_and_args in enumerate(self.queries):
-            query, args = query_and_args
-            operation = query.__name__
-
-            if "select" in operation:
-                lock_success = self.__acquire_lock_for_select(args)
-                if lock_success == False:
-                    return False
-            elif "sum" in operation:
-                lock_success = self.__acquire_lock_for_sum(args)
-                if lock_success == False:
-                    return False
-            elif "insert" in operation:
-                lock_success = self.__acquire_lock_for_insert(i)
-                if lock_success == False:
-                    return False
-                elif lock_success == -1:
-                    return -1
-            elif "update" in operation:
-                lock_success = self.__acquire_lock_for_update(args)
-                if lock_success == False:
-                    return False
-                elif lock_success == -1:
-                    return -1
-            elif "delete" in operation:
-                lock_success = self.__acquire_lock_for_delete(args)
-                if lock_success == False:
-                    return False
-                elif lock_success == -1:
-                    return -1
+        # Collect the RIDs every query needs locked first, so all locks are
+        # requested at once in increasing RID order with duplicates removed
+        shared_rids = []
+        exclusive_rids = []
+        for query, args, get_rids, is_exclusive in self.queries:
+            rids = get_rids(args)
+
+            # If an integrity constraint is violated, return -1
+            if rids == -1:
+                return -1
+
+            if is_exclusive:
+                exclusive_rids += rids
+            else:
+                shared_rids += rids
+
+        lock_manager = self.table.lock_manager
+        exclusive_rids = sorted(set(exclusive_rids))
+        if len(exclusive_rids) > 0:
+            if not lock_manager.acquire_exclusive_lock(exclusive_rids, self.id):
+                return False
+
+        # Records locked exclusively are not locked again as shared
+        shared_rids = sorted(set(shared_rids).difference(exclusive_rids))
+        if len(shared_rids) > 0:
+            if not lock_manager.acquire_shared_lock(shared_rids, self.id):
+                return False
         return True
 
-    def __acquire_lock_for_select(self, args):
+    # Returns (<method returning the RIDs @query locks>, <if the locks are exclusive>)
+    def __get_lock_handler(self, query):
+        operation = query.__name__
+        if "select" in operation:
+            handler = (self.__get_rids_to_lock_for_select, False)
+        elif "sum" in operation:
+            handler = (self.__get_rids_to_lock_for_sum, False)
+        elif "insert" in operation:
+            handler = (self.__get_rids_to_lock_for_insert, True)
+        elif "update" in operation:
+            handler = (self.__get_rids_to_lock_for_update, True)
+        elif "delete" in operation:
+            handler = (self.__get_rids_to_lock_for_delete, True)
+        else:
+            handler = (self.__get_no_rids_to_lock, False)
+        return handler
+
+    def __get_no_rids_to_lock(self, args):
+        return []
+
+    def __get_rids_to_lock_for_select(self, args):
         search_column = args[SELECT_SEARCH_KEY_COL_ARG]
         search_key = args[SELECT_SEARCH_KEY_ARG]
         rids = []
@@ -123,16 +143,12 @@ class Transaction:
             # Request a lock on all base records
             rids = self.table.index.get_all_base_rids()
 
-        # If no RIDs are found, there are no locks to be granted, so return True
+        # If no RIDs are found, there are no locks to be granted
         if rids == -1:
-            return True
-
-        # Request a lock for necessary RIDs
-        if not self.table.lock_manager.acquire_shared_lock(rids, self.id):
-            return False
-        return True
+            return []
+        return rids
 
-    def __acquire_lock_for_sum(self, args):
+    def __get_rids_to_lock_for_sum(self, args):
         start = args[SUM_START_RANGE_ARG]
         end = args[SUM_END_RANGE_ARG]
 
@@ -140,19 +156,15 @@ class Transaction:
             start, end, self.table.key + DATA_COL_START
         )
 
-        # If no RIDs are found, there are no locks to be granted, so return True
+        # If no RIDs are found, there are no locks to be granted
         if rids == -1:
-            return True
-
-        # Request a lock for all RIDs within the range
-        if not self.table.lock_manager.acquire_shared_lock(rids, self.id):
-            return False
-        return True
+            return []
+        return rids
 
-    def __acquire_lock_for_insert(self, query_index):
+    def __get_rids_to_lock_for_insert(self, args):
         # Check integrity constraint: Cannot insert a record with an existing primary key
         if self.table.index.is_indexed(DATA_COL_START + self.table.key):
-            inserted_primary_key = self.queries[query_index][1][self.table.key]
+            inserted_primary_key = args[self.table.key]
 
             # Check if primary key already exists, return -1 if it does
             rids = self.table.index.locate(
@@ -163,51 +175,42 @@ class Transaction:
                 return -1
 
         # Get the RID of the record to insert
-        rid = self.table.use_num_records("p")
-
-        # Request an exclusive lock
-        if not self.table.lock_manager.acquire_exclusive_lock([rid], self.id):
-            return False
+        # A retried transaction reuses the RID added to the insert query in its
+        # previous run
+        if len(args) > self.table.num_columns:
+            rid = args[-1]
+        else:
+            rid = self.table.use_num_records("p")
+            # Add the RID to the insert query
+            args.append(rid)
 
-        # Add the RID to the insert query
-        self.queries[query_index][1] = list(self.queries[query_index][1])
-        self.queries[query_index][1].append(rid)
+        return [rid]
 
-        return True
-
-    def __acquire_lock_for_update(self, args):
+    def __get_rids_to_lock_for_update(self, args):
         primary_key = args[UPDATE_PRIMARY_KEY_ARG]
-        rid = None
 
         # Check integrity constraint: Cannot update primary key to existing primary key
         updated_primary_key = args[self.table.key + UPDATE_PRIMARY_KEY_ARG + 1]
         if updated_primary_key != None and updated_primary_key != primary_key:
             # Check if primary key already exists, return -1 if it does
-            rid = self.table.index.locate(
+            if self.table.index.contains(
                 DATA_COL_START + self.table.key, updated_primary_key
-            )
-            if rid != -1:
+            ):
                 return -1
-        else:
-            rid = self.table.index.locate(self.table.key + DATA_COL_START, primary_key)
 
-        # If no RID is found, there are no locks to be granted, so return True
-        if rid == -1:
-            return True
+        rids = self.table.index.locate(self.table.key + DATA_COL_START, primary_key)
 
-        if not self.table.lock_manager.acquire_exclusive_lock(rid, self.id):
-            return False
-        return True
+        # If no RID is found, there are no locks to be granted
+        if rids == -1:
+            return []
+        return rids
 
-    def __acquire_lock_for_delete(self, args):
+    def __get_rids_to_lock_for_delete(self, args):
         primary_key = args[DELETE_PRIMARY_KEY_ARG]
 
-        rid = self.table.index.locate(self.table.key + DATA_COL_START, primary_key)
+        rids = self.table.index.locate(self.table.key + DATA_COL_START, primary_key)
 
-        # If no RID is found, there are no locks to be granted, so return True
-        if rid == -1:
-            return True
-
-        if not self.table.lock_manager.acquire_exclusive_lock(rid, self.id):
-            return False
-        return True
\ No newline at end of file
+        # If no RID is found, there are no locks to be granted
+        if rids == -1:
+            return []
+        return rids
\ No newline at end of file
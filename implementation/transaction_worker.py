@@ -41,7 +41,10 @@ class TransactionWorker:
         # print(f"{self.thread} joined")
 
     def __run(self):
-        for transaction in self.transactions:
+        # One entry per transaction, set to True once it stops being retried,
+        # either because it committed or because it violated an integrity constraint
+        self.stats = [False] * len(self.transactions)
+        for i, transaction in enumerate(self.transactions):
             # print(f"{threading.current_thread()} running transaction {transaction.id}")
             # Keep retrying the transaction if it aborts
 
@@ -54,15 +57,13 @@ class TransactionWorker:
                     break
                 # if integrity constraint violated
                 elif val == -1:
-                    self.stats.append(False)
                     # go to next transcation
                     break
                 # transaction aborted due to lock conflict
                 else:
-                    self.stats.append(False)
                     continue
 
-            self.stats.append(True)
+            self.stats[i] = True
 
-        # Counts the number of transactions that committed
-        self.result = len(list(filter(lambda x: x, self.stats)))
\ No newline at end of file
+        # Counts the number of transactions that stopped being retried
+        self.result = self.stats.count(True)
\ No newline at end of file